@@ -1,6 +1,20 @@
 #! /usr/bin/env python3
 
 import argparse, serial, time, datetime, scipy.signal, numpy, math, copy, textwrap, os
+import sqlite3, re, threading, queue, json, base64, socketserver, http.server
+import concurrent.futures, serial.tools.list_ports, contextlib, cProfile, collections
+import subprocess
+from html import escape
+
+try:
+    import pyarrow, pyarrow.parquet, pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 def processArguments():
     parser = argparse.ArgumentParser(description='Talk to a Fluke ScopeMeter.')
@@ -11,6 +25,32 @@ def processArguments():
             default='/dev/ttyUSB0',
             help='serial port name (/dev/ttyS0)')
 
+    parser.add_argument(
+            '-M',
+            '--meter',
+            metavar='NAME',
+            help='use the ScopeMeter with this model (199C) or the serial '
+                'number of its USB adapter instead of --port')
+
+    parser.add_argument(
+            '--discover',
+            action='store_true',
+            help='probe all serial ports for ScopeMeters')
+
+    parser.add_argument(
+            '--discover-timeout',
+            type=float,
+            default=10.0,
+            metavar='SECONDS',
+            help='give up on ports that have not answered by then (10)')
+
+    parser.add_argument(
+            '--port-cache',
+            default=os.path.expanduser('~/.flukereader-ports.json'),
+            metavar='FILE',
+            help='where discovered ports are remembered '
+                '(~/.flukereader-ports.json)')
+
     parser.add_argument(
             '-i',
             '--identify',
@@ -21,7 +61,42 @@ def processArguments():
             '-d',
             '--datetime',
             action='store_true',
-            help='set the date/time of the ScopeMeter')
+            help='set the date/time of the ScopeMeter if its clock is off '
+                'by more than --resync')
+
+    parser.add_argument(
+            '--clock',
+            action='store_true',
+            help='measure the offset and drift of the ScopeMeter clock')
+
+    parser.add_argument(
+            '--resync',
+            type=float,
+            default=1.0,
+            metavar='SECONDS',
+            help='only set the date and time when the clock is off by more '
+                'than this (1.0)')
+
+    parser.add_argument(
+            '--merge',
+            nargs='+',
+            metavar='CAPTURE[@NAME]',
+            help='put archived captures (.npz) from several ScopeMeters on '
+                'one time grid, using the clock measurements of NAME, and '
+                'write them to .dat files')
+
+    parser.add_argument(
+            '--merge-step',
+            type=float,
+            metavar='SECONDS',
+            help='sample spacing for --merge (the finest of the captures)')
+
+    parser.add_argument(
+            '--clocks',
+            default=os.path.expanduser('~/.flukereader-clocks.json'),
+            metavar='FILE',
+            help='where clock measurements are kept '
+                '(~/.flukereader-clocks.json)')
 
     parser.add_argument(
             '-s',
@@ -41,96 +116,477 @@ def processArguments():
             action='store_true',
             help='Generate an html report of results')
 
+    parser.add_argument(
+            '--page-size',
+            type=int,
+            default=25,
+            metavar='N',
+            help='figures per page of the html report (25)')
+
+    parser.add_argument(
+            '--interactive',
+            action='store_true',
+            help='draw time traces in the html report from binary samples '
+                'so they can be zoomed')
+
+    parser.add_argument(
+            '--daemon',
+            metavar='ADDRESS',
+            help='share the ScopeMeter with other programs over a unix socket '
+                '(path) or HTTP (host:port)')
+
+    parser.add_argument(
+            '--cache-ttl',
+            type=float,
+            default=1.0,
+            metavar='SECONDS',
+            help='how long the daemon reuses a result (1.0)')
+
+    parser.add_argument(
+            '--watch',
+            metavar='RULES',
+            help='poll readings (11, 21...) and download the waveforms and a '
+                'screenshot whenever one goes past a bound, e.g. 11>2.5,21<0.1')
+
+    parser.add_argument(
+            '--poll',
+            type=float,
+            default=1.0,
+            metavar='SECONDS',
+            help='how often --watch reads the readings (1.0)')
+
+    parser.add_argument(
+            '--watch-sources',
+            metavar='SOURCES',
+            help='waveforms to download on a --watch event, e.g. 10,20 '
+                '(the inputs of the reading)')
+
+    parser.add_argument(
+            '--watch-log',
+            default='watch.jsonl',
+            metavar='FILE',
+            help='where --watch events are recorded (watch.jsonl)')
+
+    parser.add_argument(
+            '-r',
+            '--raw',
+            action='store_true',
+            help='also archive the raw sample codes of each waveform (.npz)')
+
+    parser.add_argument(
+            '-a',
+            '--average',
+            type=int,
+            default=1,
+            metavar='N',
+            help='average N captures of each waveform')
+
+    parser.add_argument(
+            '--trigger',
+            metavar='CONDITIONS',
+            help='for triggered captures, keep those with any of '
+                'level=V, slope=rising|falling|either, runt=LOW:HIGH, '
+                'glitch=V, sentinels=N or rms=FRACTION (asked for)')
+
+    parser.add_argument(
+            '--trigger-context',
+            default='1,1',
+            metavar='PRE,POST',
+            help='captures kept before and after each trigger (1,1)')
+
+    parser.add_argument(
+            '--filter',
+            metavar='STAGES',
+            help='filter time traces as they are downloaded, carrying the '
+                'filter state from one capture to the next: any of notch=HZ, '
+                'lowpass=HZ, highpass=HZ and dc[=HZ], e.g. notch=50,lowpass=2000')
+
+    parser.add_argument(
+            '-m',
+            '--measure',
+            metavar='TYPES',
+            help='compute these measurements (Mean,RMS,Frequency... or all) '
+                'from each downloaded waveform')
+
+    parser.add_argument(
+            '-c',
+            '--catalog',
+            default='captures.sqlite',
+            help='capture catalog database (captures.sqlite)')
+
+    parser.add_argument(
+            '--no-catalog',
+            action='store_true',
+            help='do not record captures in the catalog')
+
+    parser.add_argument(
+            '--from-captures',
+            nargs='?',
+            const='.',
+            metavar='DIRECTORY',
+            help='make the tex/html reports from figures saved earlier '
+                '(current directory) instead of the ScopeMeter')
+
+    parser.add_argument(
+            '--export',
+            metavar='DIRECTORY',
+            help='append the waveforms of every figure to a columnar dataset '
+                '(Parquet or HDF5 if installed, otherwise npz)')
+
+    parser.add_argument(
+            '--export-query',
+            metavar='DIRECTORY',
+            help='write the captures of an --export dataset that match '
+                '--channel, --since and --until to one csv file')
+
+    parser.add_argument(
+            '--export-output',
+            default='export.csv',
+            metavar='FILE',
+            help='where --export-query writes (export.csv)')
+
+    parser.add_argument(
+            '--batch',
+            metavar='DIRECTORY',
+            help='analyse every archived capture (.npz) in a directory')
+
+    parser.add_argument(
+            '--batch-output',
+            default='batch.sqlite',
+            metavar='FILE',
+            help='where batch results go; an interrupted batch resumes '
+                '(batch.sqlite)')
+
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            metavar='N',
+            help='processes for --batch and --render (one per core)')
+
+    parser.add_argument(
+            '--render',
+            action='store_true',
+            help='render the report figures right away with a pool of '
+                'long-lived gnuplot processes instead of leaving it to make')
+
+    parser.add_argument(
+            '--scan',
+            metavar='DIRECTORY',
+            help='add existing captures in a directory to the catalog')
+
+    parser.add_argument(
+            '--pyramid',
+            metavar='DIRECTORY',
+            help='extract a span of a logged pyramid to a .dat file')
+
+    parser.add_argument(
+            '--span',
+            metavar='START,END',
+            help='seconds into the pyramid to extract (everything)')
+
+    parser.add_argument(
+            '--points',
+            type=int,
+            default=2000,
+            help='approximate number of points to extract (2000)')
+
+    parser.add_argument(
+            '-q',
+            '--query',
+            action='store_true',
+            help='list captures in the catalog matching the filters below')
+
+    parser.add_argument(
+            '--channel',
+            help='only query captures of this channel (A, B, both)')
+
+    parser.add_argument(
+            '--type',
+            help='only query captures of this trace type (trace, envelope...)')
+
+    parser.add_argument(
+            '--unit',
+            help='only query captures with this y unit (V, A, W...)')
+
+    parser.add_argument(
+            '--since',
+            help='only query captures taken on or after this time '
+                '(YYYY-MM-DD [HH:MM:SS])')
+
+    parser.add_argument(
+            '--until',
+            help='only query captures taken on or before this time '
+                '(YYYY-MM-DD [HH:MM:SS])')
+
+    parser.add_argument(
+            '--write-queue',
+            type=int,
+            default=16,
+            metavar='N',
+            help='files that may wait to be written in the background while '
+                'acquisition goes on, 0 to write them in place (16)')
+
+    parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='report the time spent in each phase of the run')
+
+    parser.add_argument(
+            '--profile-dump',
+            metavar='FILE',
+            help='also write cProfile statistics to this file (pstats)')
+
     arguments = parser.parse_args()
+    if arguments.page_size < 1:
+        parser.error("--page-size must be at least 1")
+    # --from-captures changes directory before exporting
+    if arguments.export:
+        arguments.export = os.path.abspath(arguments.export)
+    if arguments.no_catalog and (arguments.scan or arguments.query):
+        parser.error("--scan and --query need the catalog, so not with --no-catalog")
     return arguments
 
+# Wall and CPU seconds per phase of the run when --profile is on
+phases = None
+# Each thread nests its own phases
+phaseStack = threading.local()
+phaseLock = threading.Lock()
+
+@contextlib.contextmanager
+def phase(name):
+    if phases == None:
+        yield
+        return
+
+    if not hasattr(phaseStack, 'frames'):
+        phaseStack.frames = []
+    stack = phaseStack.frames
+    stack.append([0.0, 0.0, name])
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter()-wall
+        cpu = time.process_time()-cpu
+        # Time spent in nested phases only counts for those
+        nested = stack.pop()
+        if len(stack):
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+        with phaseLock:
+            entry = phases.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += wall-nested[0]
+            entry[2] += cpu-nested[1]
+
+def phaseCurrent():
+    # The innermost phase of this thread, None outside any
+    frames = getattr(phaseStack, 'frames', [])
+    return frames[-1][2] if len(frames) else None
+
+# Files waiting to be written by the write-behind thread
+writer = None
+
+class writer_t:
+    queue = None
+    thread = None
+    errors = None
+    written = None
+    failures = 0
+
+def writerServe(writer):
+    # A failed file is reported and the jobs behind it are still written
+    while True:
+        job = writer.queue.get()
+        try:
+            if job == None:
+                return
+            filename, mode, write, arguments, name = job
+            # The formatting counts for the phase that queued it
+            with phase(name) if name != None else contextlib.nullcontext():
+                with open(filename, mode) as outputFile:
+                    write(outputFile, *arguments)
+            writer.written.append(filename)
+        except Exception as error:
+            writer.errors.put((filename, error))
+        finally:
+            writer.queue.task_done()
+
+def writerStart(depth):
+    global writer
+    if depth <= 0:
+        return
+    writer = writer_t()
+    writer.queue = queue.Queue(depth)
+    writer.errors = queue.Queue()
+    writer.written = []
+    writer.thread = threading.Thread(target=writerServe, args=(writer,), daemon=True)
+    writer.thread.start()
+
+def writerReport():
+    while writer != None and not writer.errors.empty():
+        filename, error = writer.errors.get()
+        print("error: writing {:s} failed: {:s}".format(filename, str(error)))
+        writer.failures += 1
+
+def writerSync(filenames):
+    # One barrier at the end for everything written: the files, then the
+    # directories holding their entries
+    for filename in filenames:
+        with open(filename, 'ab') as outputFile:
+            os.fsync(outputFile.fileno())
+    for directory in set([os.path.dirname(filename) for filename in filenames]):
+        try:
+            descriptor = os.open(directory, os.O_RDONLY)
+        except OSError:
+            # Windows does not open directories
+            continue
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+def writerDrain():
+    # Everything queued is on disk before it is read back or the working
+    # directory changes
+    if writer != None:
+        writer.queue.join()
+    writerReport()
+
+def writeBehind(filename, mode, write, *arguments):
+    # Formatting and writing happen on the write-behind thread when there
+    # is one; a full queue holds acquisition back until it catches up.
+    # Returns whether the file is still to be written.
+    writerReport()
+    if writer == None:
+        with open(filename, mode) as outputFile:
+            write(outputFile, *arguments)
+        return False
+    writer.queue.put((
+        os.path.abspath(filename),
+        mode,
+        write,
+        arguments,
+        phaseCurrent()))
+    return True
+
+def writerStop():
+    # The number of files that could not be written
+    global writer
+    if writer == None:
+        return 0
+    waiting = writer.queue.unfinished_tasks > 0
+    if waiting:
+        print("Waiting for output to be written...", end="", flush=True)
+    writer.queue.put(None)
+    writer.thread.join()
+    writerSync(writer.written)
+    if waiting:
+        print("done")
+    writerReport()
+    failures = writer.failures
+    writer = None
+    return failures
+
+def profileStart(enabled, dumpName=None):
+    global phases
+    if enabled:
+        phases = {}
+    profiler = None
+    if dumpName:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+def profileStop(profiler, dumpName=None):
+    if profiler != None:
+        profiler.disable()
+        profiler.dump_stats(dumpName)
+        print("Wrote profile to "+dumpName)
+
+    if phases == None:
+        return
+    print("\n***** Profile *****")
+    print("{:<20s} {:>6s} {:>10s} {:>10s}".format("Phase", "Count", "Wall (s)", "CPU (s)"))
+    for name, (count, wall, cpu) in sorted(
+            phases.items(),
+            key=lambda item: -item[1][1]):
+        print("{:<20s} {:>6d} {:>10.3f} {:>10.3f}".format(name, count, wall, cpu))
+
+class ScopeMeterError(Exception):
+    pass
+
+# Extra seconds the meter may spend before acknowledging these commands,
+# and again before the first byte of the reply
+busy = {
+        "QM": 1.0,
+        "QP": 10.0,
+        "QW": 1.0,
+        "CM": 10.0}
+
+def readBytes(port, size, wait=0.0):
+    # The port timeout holds the link latency; give bulk reads twice the
+    # time their bytes need on the wire (10 bits each) on top of that
+    latency = port.timeout
+    port.timeout = latency + wait + 20.0*size/port.baudrate
+    try:
+        return port.read(size)
+    finally:
+        port.timeout = latency
+
+class buffer_t:
+    data = bytearray()
+
+def bufferView(buffer, size):
+    # Reused from one transfer to the next; a bigger one replaces it only
+    # when a transfer outgrows it
+    if len(buffer.data) < size:
+        buffer.data = bytearray(max(size, 2*len(buffer.data)))
+    return memoryview(buffer.data)[:size]
+
+def readInto(port, view, wait=0.0):
+    latency = port.timeout
+    port.timeout = latency + wait + 20.0*len(view)/port.baudrate
+    try:
+        return port.readinto(view)
+    finally:
+        port.timeout = latency
+
 def sendCommand(port, command, timeout=True):
     data = bytearray(command.encode("ascii"))
     data.append(ord('\r'))
     port.write(data)
     port.flush()
-    ack = port.read(2)
+    ack = readBytes(port, 2, busy.get(command[:2], 0.0))
 
     if len(ack) != 2:
         if timeout:
-            print("error: command acknowledgement timed out")
-            exit(1)
+            raise ScopeMeterError("command acknowledgement timed out")
         else:
             return False
     
     if ack[1] != ord('\r'):
-        print("error: did not receive CR after acknowledgement code")
-        exit(1)
+        raise ScopeMeterError("did not receive CR after acknowledgement code")
 
     code = int(chr(ack[0]))
 
     if code == 0:
         return
     elif code == 1:
-        print("error: Command syntax error")
+        raise ScopeMeterError("Command syntax error")
     elif code == 2:
-        print("error: Command execution error")
+        raise ScopeMeterError("Command execution error")
     elif code == 3:
-        print("error: Synchronization error")
+        raise ScopeMeterError("Synchronization error")
     elif code == 4:
-        print("error: Communication error")
+        raise ScopeMeterError("Communication error")
     else:
-        print(
-                "error: Unknown error code ("
+        raise ScopeMeterError(
+                "Unknown error code ("
                 +str(code)
                 +") in command acknowledgement")
-    exit(1)
-
-    return True
-
-def initializePort(portName):
-    print("Opening and configuring serial port...", end="", flush=True)
-    port = serial.Serial(portName, 1200, timeout=1)
-    print("done")
-
-    print("Reconciling serial port baud rate...", end="", flush=True)
-    status = sendCommand(port, "PC 19200", False)
-    port.baudrate = 19200
-    if status == False:
-        sendCommand(port, "PC 19200")
-    print("done")
-
-    return port
-
-def identify(port):
-    print("Getting identity of ScopeMeter...", end="", flush=True)
-    sendCommand(port, "ID")
-    identity = bytearray()
-    while True:
-        byte = port.read()
-        if len(byte) != 1:
-            print("error: timeout while receiving data")
-            exit(1)
-        if byte[0] == ord('\r'):
-            break;
-        identity.append(byte[0])
-
-    identity = identity.split(b';')
-    if len(identity) != 4:
-        print("error: unable to decode identity string")
-        exit(1)
-    model = identity[0].decode()
-    firmware = identity[1].decode()
-    date = time.strptime(identity[2].decode(), "%Y-%m-%d")
-    languages = identity[3].decode()
-    print("done")
-    print("     Model: "+model)
-    print("   Version: "+firmware)
-    print("Build Date: "+time.strftime("%B %d, %Y", date))
-
-def dateTime(port):
-    datetime = time.localtime(time.time()+1)
-    print("Setting time of ScopeMeter...", end="", flush=True)
-    sendCommand(port, "WT "+time.strftime("%H,%M,%S", datetime))
-    print("done")
-    print("Setting date of ScopeMeter...", end="", flush=True)
-    sendCommand(port, "WD "+time.strftime("%Y,%m,%d", datetime))
-    print("done")
 
 def getUInt(data):
     return int.from_bytes(data, byteorder='big', signed=False)
@@ -144,41 +600,41 @@ def getFloat(data):
 
     return float(mantissa * 10.0**exponent)
 
-def getHeader(port, intSize):
+def getHeader(port, intSize, buffer=None, wait=0.0):
+    if buffer == None:
+        buffer = buffer_t()
     dataSize = 3+intSize
-    data = port.read(dataSize)
-    if len(data) != dataSize:
-        print("error: header reception timed out")
-        exit(1)
+    data = bufferView(buffer, dataSize)
+    if readInto(port, data, wait) != dataSize:
+        raise ScopeMeterError("header reception timed out")
     if data[0:2] != b"#0":
-        print("error: header preamble incorrect")
-        exit(1)
+        raise ScopeMeterError("header preamble incorrect")
 
     header = int(data[2])
     size = getUInt(data[3:3+intSize])
 
     return (header, size)
 
-def getData(port, size):
+def getData(port, size, buffer=None):
+    # The data is a view into the buffer, good until its next transfer
+    if buffer == None:
+        buffer = buffer_t()
     size += 1
-    data = port.read(size)
-    if len(data) != size:
-        print("error: data reception timed out")
-        exit(1)
+    data = bufferView(buffer, size)
+    if readInto(port, data) != size:
+        raise ScopeMeterError("data reception timed out")
     if not checksum(data[:-1], data[-1]):
-        print("error: checksum failed")
-        exit(1)
+        raise ScopeMeterError("checksum failed")
     return data[:-1]
 
-def getDecimal(port, sep=False):
+def getDecimal(port, sep=False, wait=0.0):
     # Now get the number
     number = ""
     floating = False
+    byte = readBytes(port, 1, wait)
     while True:
-        byte = port.read()
         if len(byte) != 1:
-            print("error: data length reception timed out")
-            exit(1)
+            raise ScopeMeterError("data length reception timed out")
         byte = byte[0]
         if (ord('0') > byte or byte > ord('9')) \
                 and byte != ord('.') \
@@ -188,6 +644,7 @@ def getDecimal(port, sep=False):
         if byte == ord('.'):
             floating = True
         number += chr(byte)
+        byte = port.read()
 
     separator = byte
 
@@ -201,73 +658,645 @@ def getDecimal(port, sep=False):
 
     if sep != False:
         if ord(sep) != separator:
-            print("error: invalid field separator after decimal")
-            exit(1)
+            raise ScopeMeterError("invalid field separator after decimal")
         return number
     return (number, separator)
 
+def getLine(port, wait=0.0):
+    line = bytearray()
+    byte = readBytes(port, 1, wait)
+    while True:
+        if len(byte) != 1:
+            raise ScopeMeterError("timeout while receiving data")
+        if byte[0] == ord('\r'):
+            break;
+        line.append(byte[0])
+        byte = port.read()
+    return line
+
 def checksum(data, check):
-    checksum = 0
-    for byte in data:
-        checksum += byte
-        checksum %= 256
+    checksum = int(numpy.frombuffer(data, numpy.uint8).sum(dtype=numpy.uint64))%256
 
     return (checksum == check)
 
-def screenshot(port):
-    print("Downloading screenshot from ScopeMeter...", end="", flush=True)
-    sendCommand(port, "QP 0,12,B")
+def decodeAdmin(data):
+    waveform = waveform_t()
+
+    waveform.y_unit = units[data[1]]
+    waveform.x_unit = units[data[2]]
+    waveform.y_divisions = getUInt(data[3:5])
+    waveform.x_divisions = getUInt(data[5:7])
+    waveform.y_scale = getFloat(data[7:10])
+    waveform.x_scale = getFloat(data[10:13])
+    waveform.y_zero = getFloat(data[15:18])
+    waveform.x_zero = getFloat(data[18:21])
+    waveform.y_resolution = getFloat(data[21:24])
+    waveform.delta_x = getFloat(data[24:27])
+    waveform.y_at_0 = getFloat(data[27:30])
+    waveform.timestamp = datetime.datetime(
+            int(data[33:37]),
+            int(data[37:39]),
+            int(data[39:41]),
+            int(data[41:43]),
+            int(data[43:45]),
+            int(data[45:47]))
+
+    return waveform
+
+def decodeSamples(waveform):
+    samples = waveform.y_zero + waveform.codes*waveform.y_resolution
+    samples[waveform.codes == waveform.overload] = numpy.inf
+    samples[waveform.codes == waveform.underload] = -numpy.inf
+    samples[waveform.codes == waveform.invalid] = numpy.nan
+    return samples
+
+def decodeRows(waveform, start, end):
+    codes = waveform.codes[start:end]
+    samples = waveform.samples[start:end]
+    numpy.multiply(codes, waveform.y_resolution, out=samples)
+    samples += waveform.y_zero
+    samples[codes == waveform.overload] = numpy.inf
+    samples[codes == waveform.underload] = -numpy.inf
+    samples[codes == waveform.invalid] = numpy.nan
+
+def sampleBlockHead(data):
+    # Format byte, the three sentinels and the number of samples
+    return 1 + 3*(data[0]&0b00000111) + 2
+
+def decodeSampleBlockHead(waveform, data, trend=False):
+    getNumber = getUInt
+    signed = 'u'
+    if data[0]&0b10000000 != 0:
+        getNumber = getInt
+        signed = 'i'
+    sample_size =    data[0]&0b00000111
+    samples_per_sample = 1
+
+    if data[0]&0b01110000 == 0b01000000:
+        samples_per_sample = 2
+    if data[0]&0b01110000 == 0b01100000:
+        samples_per_sample = 3
+    if data[0]&0b01110000 == 0b01110000:
+        if trend:
+            samples_per_sample = 3
+        else:
+            samples_per_sample = 2
+
+    pointer = 1
+    waveform.overload = getNumber(data[pointer:pointer+sample_size])
+    pointer += sample_size
+    waveform.underload = getNumber(data[pointer:pointer+sample_size])
+    pointer += sample_size
+    waveform.invalid = getNumber(data[pointer:pointer+sample_size])
+    pointer += sample_size
+    nbr_of_samples = getUInt(data[pointer:pointer+2])
+
+    return signed+str(sample_size), nbr_of_samples, samples_per_sample
+
+def getSampleBlock(port, size, waveform, trend=False, buffer=None, chunk=1024):
+    # Rows are decoded a chunk at a time as they arrive, with the checksum
+    # kept running, rather than all at once after the last byte
+    if buffer == None:
+        buffer = buffer_t()
+    data = bufferView(buffer, sampleBlockHead([0b111]))
+    if readInto(port, data[:1]) != 1:
+        raise ScopeMeterError("data reception timed out")
+    head = sampleBlockHead(data)
+    data = data[:head]
+    if head > size or readInto(port, data[1:]) != head-1:
+        raise ScopeMeterError("data reception timed out")
+    kind, nbr_of_samples, samples_per_sample = \
+            decodeSampleBlockHead(waveform, data, trend)
+    total = int(numpy.frombuffer(data, numpy.uint8).sum(dtype=numpy.uint64))
+    data.release()
+
+    rowSize = samples_per_sample*int(kind[1:])
+    if head + nbr_of_samples*rowSize != size:
+        raise ScopeMeterError("number of samples does not match block size")
+
+    waveform.codes = numpy.empty([nbr_of_samples, samples_per_sample], kind)
+    waveform.samples = numpy.empty([nbr_of_samples, samples_per_sample])
+    codes = waveform.codes.reshape(-1)
+    rows = max(1, chunk//rowSize)
+    for start in range(0, nbr_of_samples, rows):
+        end = min(start+rows, nbr_of_samples)
+        data = bufferView(buffer, (end-start)*rowSize)
+        if readInto(port, data) != len(data):
+            raise ScopeMeterError("data reception timed out")
+        with phase("decode"):
+            total += int(numpy.frombuffer(data, numpy.uint8).sum(dtype=numpy.uint64))
+            codes[start*samples_per_sample:end*samples_per_sample] = \
+                    numpy.frombuffer(data, '>'+kind)
+            decodeRows(waveform, start, end)
+
+    data = bufferView(buffer, 1)
+    if readInto(port, data) != 1:
+        raise ScopeMeterError("data reception timed out")
+    if total%256 != data[0]:
+        raise ScopeMeterError("checksum failed")
+
+class identity_t:
+    model = ""
+    firmware = ""
+    date = None
+    languages = ""
+
+class reading_t:
+    no = 0
+    valid = False
+    source = 0
+    unit = 0
+    thetype = 0
+    pres = 0
+    resolution = 0.0
+
+class ScopeMeter:
+    def __init__(self, portName, baudrate=19200):
+        # serial_for_url also takes plain device names
+        self.port = serial.serial_for_url(portName, 1200, timeout=1)
+        self.baudrate = 1200
+        self.buffer = buffer_t()
+        self.filter = None
+        try:
+            status = sendCommand(self.port, "PC {:d}".format(baudrate), False)
+            self.port.baudrate = baudrate
+            if status == False:
+                # It was probably still talking at the new rate already
+                sendCommand(self.port, "PC {:d}".format(baudrate))
+            self.baudrate = baudrate
+            self.latency = self.measureLatency()
+        except:
+            self.port.close()
+            raise
+        self.port.timeout = self.latency
+
+    def measureLatency(self, tries=3):
+        # Time the acknowledgement of a harmless command, less the time
+        # the characters themselves spend on the wire
+        slowest = 0.0
+        for attempt in range(tries):
+            start = time.monotonic()
+            self.command("ID")
+            elapsed = time.monotonic()-start - 50.0/self.port.baudrate
+            getLine(self.port)
+            slowest = max(slowest, elapsed)
+        return max(4*slowest, 0.05)
+
+    def close(self):
+        self.port.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def command(self, command):
+        sendCommand(self.port, command)
+
+    def identify(self):
+        self.command("ID")
+
+        fields = getLine(self.port).split(b';')
+        if len(fields) != 4:
+            raise ScopeMeterError("unable to decode identity string")
+        identity = identity_t()
+        identity.model = fields[0].decode()
+        identity.firmware = fields[1].decode()
+        identity.date = datetime.datetime.strptime(fields[2].decode(), "%Y-%m-%d")
+        identity.languages = fields[3].decode()
+
+        return identity
+
+    def set_datetime(self, moment=None):
+        if moment == None:
+            # The commands take about a second to get through
+            moment = datetime.datetime.now() + datetime.timedelta(seconds=1)
+        self.command("WT "+moment.strftime("%H,%M,%S"))
+        self.command("WD "+moment.strftime("%Y,%m,%d"))
+
+    def read_date(self):
+        self.command("RD")
+        fields = getLine(self.port).split(b',')
+        if len(fields) != 3:
+            raise ScopeMeterError("unable to decode date")
+        return datetime.date(*[int(field) for field in fields])
+
+    def read_time(self):
+        self.command("RT")
+        fields = getLine(self.port).split(b',')
+        if len(fields) != 3:
+            raise ScopeMeterError("unable to decode time")
+        return datetime.time(*[int(field) for field in fields])
+
+    def screenshot(self):
+        self.command("QP 0,12,B")
     
-    dataLength = getDecimal(port, ',')
+        dataLength = getDecimal(self.port, ',', busy["QP"])
 
-    image = bytearray()
-    status = 0
-    retries = 0
-    while True:
-        # Let's initiate a segment transfer
-        sendCommand(port, "{:d}".format(status))
+        # Segments land straight in the image, their checksum and CR in
+        # the two bytes past it until the next segment overwrites them
+        image = bytearray(dataLength+2)
+        position = 0
+        status = 0
+        retries = 0
+        while True:
+            # Let's initiate a segment transfer
+            self.command("{:d}".format(status))
+
+            header, size = getHeader(self.port, 2, self.buffer, busy["QP"])
+            if size > dataLength:
+                raise ScopeMeterError("segment is longer than the image")
+            size += 2
+
+            # Now let's fetch the data
+            data = memoryview(image)[position:position+size]
+            if readInto(self.port, data) != size:
+                raise ScopeMeterError("segment data reception timed out")
+
+            if not checksum(data[:-2], data[-2]):
+                retries += 1
+                if retries >= 3:
+                    raise ScopeMeterError("segment checksum failed 3 times")
+                status = 1
+                continue
+
+            # Check for final CR
+            if data[-1] != ord('\r'):
+                raise ScopeMeterError("did not receive terminating CR in segment")
+
+            retries = 0
+            position += size-2
+            dataLength -= size-2
+
+            if dataLength == 0 or (header&0x80) != 0:
+                if dataLength == 0 and (header&0x80) != 0:
+                    break
+                else:
+                    raise ScopeMeterError(
+                            "mismatch in data received and header flag")
 
-        header, size = getHeader(port, 2)
-        size += 2
+        data.release()
+        del image[position:]
+        return bytes(image)
 
-        # Now let's fetch the data
-        data = port.read(size)
-        if len(data) != size:
-            print("error: segment data reception timed out")
-            exit(1)
+    def waveform(self, source):
+        self.command("QW "+source)
 
-        if not checksum(data[:-2], data[-2]):
-            retries += 1
-            if retries >= 3:
-                print("error: segment checksum failed 3 times")
-                exit(1)
-            status = 1
+        # Handle the administrative data
+        header, size = getHeader(self.port, 2, self.buffer, busy["QW"])
+        if size != 47:
+            raise ScopeMeterError(
+                    "admin data is a weird size ({:d})".format(size))
+        waveform = decodeAdmin(getData(self.port, size, self.buffer))
+
+        # Get our comma separator
+        byte = self.port.read()
+        if not (len(byte) == 1 and byte[0] == ord(',')):
+            raise ScopeMeterError("invalid separator between admin and samples")
+
+        # Handle the sample data
+        # Trend plots are sources 11, 21...
+        header, size = getHeader(self.port, 4, self.buffer)
+        getSampleBlock(self.port, size, waveform, source[-1] == '1', self.buffer)
+
+        terminator = self.port.read(1)
+        if len(terminator) != 1 or terminator[0] != ord('\r'):
+            raise ScopeMeterError("got invalid terminator to trace data")
+
+        return waveform
+
+    def readings(self):
+        self.command("QM")
+
+        readings = []
+        separator = ord(',')
+        wait = busy["QM"]
+
+        while separator == ord(','):
+            reading = reading_t()
+            reading.no = getDecimal(self.port, ',', wait)
+            wait = 0.0
+            if getDecimal(self.port, ',') == 1:
+                reading.valid = True
+            reading.source = getDecimal(self.port, ',')
+            reading.unit = getDecimal(self.port, ',')
+            reading.thetype = getDecimal(self.port, ',')
+            reading.pres = getDecimal(self.port, ',')
+            
+            mantissa = getDecimal(self.port, 'E')
+            exponent, separator = getDecimal(self.port)
+            reading.resolution = mantissa * 10.0**exponent
+
+            if reading.valid:
+                readings.append(reading)
+
+        return readings
+
+    def reading(self, no):
+        self.command("QM {:d}".format(no))
+        return getDecimal(self.port, 'E', busy["QM"]) * 10.0**getDecimal(self.port, '\r')
+
+class port_t:
+    device = ""
+    # The USB adapter's serial number; ID does not give the meter's own
+    serial = None
+    model = ""
+    firmware = ""
+    date = ""
+
+def probePort(device, abandoned):
+    meter = ScopeMeter(device)
+    try:
+        # A probe that outlasts the discovery leaves the port alone
+        if abandoned.is_set():
+            return None
+        return meter.identify()
+    finally:
+        meter.close()
+
+def discoverPorts(timeout=10.0):
+    candidates = serial.tools.list_ports.comports()
+    if len(candidates) == 0:
+        return []
+
+    # The probes are mostly waiting on 1200 baud, so one thread per port
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {}
+    abandoned = threading.Event()
+    for candidate in candidates:
+        futures[pool.submit(probePort, candidate.device, abandoned)] = candidate
+    done, late = concurrent.futures.wait(futures, timeout)
+    abandoned.set()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    ports = []
+    for future in done:
+        if future.exception() != None:
             continue
+        identity = future.result()
+        port = port_t()
+        port.device = futures[future].device
+        port.serial = futures[future].serial_number
+        port.model = identity.model
+        port.firmware = identity.firmware
+        port.date = identity.date.strftime("%Y-%m-%d")
+        ports.append(port)
+    ports.sort(key=lambda port: port.device)
+
+    return ports
+
+def portsWrite(filename, ports):
+    entries = []
+    for port in ports:
+        entries.append({
+                "device": port.device,
+                "serial": port.serial,
+                "model": port.model,
+                "firmware": port.firmware,
+                "date": port.date})
+    with open(filename, 'w') as cacheFile:
+        json.dump(entries, cacheFile, indent=1)
+
+def portsRead(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as cacheFile:
+        entries = json.load(cacheFile)
+    ports = []
+    for entry in entries:
+        port = port_t()
+        for key, value in entry.items():
+            setattr(port, key, value)
+        ports.append(port)
+    return ports
+
+def portsPrint(ports):
+    print("{:<20s} {:<12s} {:<8s} {:<10s} {:s}".format(
+        "Port", "Model", "Firmware", "Date", "Adapter serial"))
+    for port in ports:
+        print("{:<20s} {:<12s} {:<8s} {:<10s} {:s}".format(
+            port.device,
+            port.model,
+            port.firmware,
+            port.date,
+            port.serial or "-"))
+
+def findMeter(name, cacheName, timeout=10.0):
+    def lookup(ports):
+        # USB adapters keep their serial number when the tty is renumbered
+        present = {}
+        for candidate in serial.tools.list_ports.comports():
+            present[candidate.device] = candidate.serial_number
+        for port in ports:
+            if name != port.serial and name.lower() not in port.model.lower():
+                continue
+            if port.serial != None:
+                for device, number in present.items():
+                    if number == port.serial:
+                        return device
+            elif port.device in present:
+                return port.device
+        return None
 
-        # Check for final CR
-        if data[-1] != ord('\r'):
-            print("error: did not receive terminating CR in segment")
-            exit(1)
+    device = lookup(portsRead(cacheName))
+    if device == None:
+        print("Probing serial ports for {:s}...".format(name), end="", flush=True)
+        ports = discoverPorts(timeout)
+        print("done")
+        portsWrite(cacheName, ports)
+        device = lookup(ports)
+        if device == None:
+            raise ScopeMeterError("no ScopeMeter matching “{:s}” found".format(name))
 
-        retries = 0
-        image += data[:-2]
-        dataLength -= len(data)-2
+    return device
 
-        if dataLength == 0 or (header&0x80) != 0:
-            if dataLength == 0 and (header&0x80) != 0:
-                break
-            else:
-                print("error: mismatch in data received and header flag")
+def initializePort(portName):
+    print("Opening and configuring serial port...", end="", flush=True)
+    with phase("port init"):
+        meter = ScopeMeter(portName)
+    print("done")
+
+    return meter
+
+def identify(meter):
+    print("Getting identity of ScopeMeter...", end="", flush=True)
+    with phase("transfer ID"):
+        identity = meter.identify()
+    print("done")
+    print("     Model: "+identity.model)
+    print("   Version: "+identity.firmware)
+    print("Build Date: "+identity.date.strftime("%B %d, %Y"))
+
+def dateTime(meter):
+    print("Setting date and time of ScopeMeter...", end="", flush=True)
+    with phase("transfer WT/WD"):
+        meter.set_datetime()
+    print("done")
+
+class clock_t:
+    points = []
+    offset = 0.0
+    drift = 0.0
+    reference = 0.0
+    uncertainty = 0.0
+
+def clockOffset(meter, limit=3.0):
+    # The clock only shows whole seconds, so poll it until it ticks over.
+    # The tick happened after the previous poll went out and before the
+    # answer to this one came back.
+    date = meter.read_date()
+    previous = None
+    start = time.time()
+    while time.time()-start < limit:
+        sent = time.time()
+        moment = meter.read_time()
+        received = time.time()
+        if previous != None and moment != previous[1]:
+            tick = datetime.datetime.combine(date, moment).timestamp()
+            host = (previous[0]+received)/2
+            return (host, tick-host, (received-previous[0])/2)
+        previous = (sent, moment)
+    raise ScopeMeterError("clock did not tick")
+
+def clockFit(points):
+    clock = clock_t()
+    clock.points = points
+    clock.reference = points[-1][0]
+    clock.offset = points[-1][1]
+    clock.uncertainty = points[-1][2]
+    # Drift only means something once the points are a while apart
+    if len(points) > 1 and points[-1][0]-points[0][0] > 60:
+        hosts = numpy.array([point[0] for point in points])-clock.reference
+        offsets = numpy.array([point[1] for point in points])
+        weights = 1/numpy.maximum([point[2] for point in points], 1e-3)
+        clock.drift, clock.offset = numpy.polyfit(hosts, offsets, 1, w=weights)
+    return clock
+
+def clockAt(clock, host):
+    return clock.offset + clock.drift*(host-clock.reference)
+
+def hostTime(clock, moment):
+    # Host seconds since the epoch for a time read off the meter's clock.
+    # The fit takes host time, which is near enough the meter time less
+    # the offset for the drift term.
+    meter = moment.timestamp()
+    return meter - clockAt(clock, meter-clock.offset)
+
+def clocksRead(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as clockFile:
+        return json.load(clockFile)
+
+def clocksWrite(filename, clocks):
+    with open(filename, 'w') as clockFile:
+        json.dump(clocks, clockFile, indent=1)
+
+def clock(meter, filename, name):
+    print("Measuring clock of ScopeMeter...", end="", flush=True)
+    with phase("transfer RD/RT"):
+        point = clockOffset(meter)
+    print("done")
+
+    clocks = clocksRead(filename)
+    clocks[name] = clocks.get(name, []) + [list(point)]
+    clocksWrite(filename, clocks)
+    fit = clockFit(clocks[name])
+    print("Clock offset: {:+.3f} s (± {:.3f} s)".format(
+        clockAt(fit, point[0]),
+        fit.uncertainty))
+    if fit.drift != 0.0:
+        print("Clock drift: {:+.2f} ppm over {:s}".format(
+            fit.drift*1e6,
+            formatSeconds(fit.points[-1][0]-fit.points[0][0])))
+    return fit
+
+def mergeWaveforms(streams, delta_x=None):
+    # Each stream is a waveform and the clock_t of the meter it came from
+    # (None for host timestamps). The result covers the span where they
+    # all overlap, resampled to the finest (or the given) spacing.
+    starts = []
+    for data, meterClock in streams:
+        if meterClock == None:
+            starts.append(data.timestamp.timestamp()+data.x_zero)
+        else:
+            starts.append(hostTime(meterClock, data.timestamp)+data.x_zero)
+    begin = max(starts)
+    end = min([start+data.delta_x*data.samples.shape[0]
+        for start, (data, meterClock) in zip(starts, streams)])
+    if delta_x == None:
+        delta_x = min([data.delta_x for data, meterClock in streams])
+    if end-begin < delta_x:
+        raise ValueError("waveforms do not overlap in time")
+    grid = begin + delta_x*numpy.arange(int((end-begin)/delta_x))
+
+    merged = []
+    for start, (data, meterClock) in zip(starts, streams):
+        times = start + data.delta_x*numpy.arange(data.samples.shape[0])
+        result = copy.copy(data)
+        result.samples = numpy.column_stack([
+            numpy.interp(grid, times, data.samples[:, column], numpy.nan, numpy.nan)
+            for column in range(data.samples.shape[1])])
+        result.timestamp = datetime.datetime.fromtimestamp(math.floor(begin))
+        result.x_zero = begin-math.floor(begin)
+        result.delta_x = delta_x
+        result.x_scale = result.x_scale*delta_x/data.delta_x
+        result.codes = None
+        result.averaged = False
+        result.uncertainty = None
+        result.minimum = None
+        result.maximum = None
+        merged.append(result)
+    return merged
+
+def merge(names, clocksName, delta_x=None):
+    # Each name is an archived capture, with @NAME for the meter whose
+    # clock measurements put its timestamps on host time
+    clocks = clocksRead(clocksName)
+    streams = []
+    for name in names:
+        filename, at, clockName = name.partition('@')
+        meterClock = None
+        if at:
+            if clockName not in clocks:
+                print("error: no clock measurements for “{:s}” in {:s}".format(
+                    clockName,
+                    clocksName))
                 exit(1)
+            meterClock = clockFit(clocks[clockName])
+        streams.append((archiveRead(filename), meterClock))
+
+    try:
+        merged = mergeWaveforms(streams, delta_x)
+    except ValueError as error:
+        print("error: "+str(error))
+        exit(1)
+
+    print("Writing {:d} merged captures of {:d} points...".format(
+        len(merged),
+        merged[0].samples.shape[0]), end="", flush=True)
+    for i in range(len(merged)):
+        filename = "{:s}_merged-{:d}.dat".format(waveformFilename(merged[i]), i+1)
+        with open(filename, 'w') as datFile:
+            datWrite(datFile, merged[i])
     print("done")
 
-    filename=time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())+".png"
-    print("Writing screenshot to "+filename+"...", end="", flush=True)
-    imageFile = open(filename, 'wb')
-    imageFile.write(image)
-    imageFile.close()
+def screenshot(meter, suffix=""):
+    print("Downloading screenshot from ScopeMeter...", end="", flush=True)
+    with phase("transfer QP"):
+        image = meter.screenshot()
     print("done")
 
+    filename=time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())+suffix+".png"
+    print("Writing screenshot to "+filename+"...", end="", flush=True)
+    if writeBehind(filename, 'wb', lambda imageFile: imageFile.write(image)):
+        print("queued")
+    else:
+        print("done")
+
+    return filename
+
 class waveform_t:
     channel = ""
     trace_type = ""
@@ -285,6 +1314,75 @@ class waveform_t:
     averaged = False
     filename = ""
     title = ""
+    codes = None
+    y_zero = 0.0
+    y_resolution = 0.0
+    overload = None
+    underload = None
+    invalid = None
+    analysis = None
+    uncertainty = None
+    minimum = None
+    maximum = None
+    filtered = ""
+
+def archiveWrite(archiveFile, waveform):
+    # Successive codes are close together so their differences compress
+    # far better than the codes themselves. The differences wrap around
+    # in the code's own integer type, so decoding is exact.
+    deltas = numpy.empty_like(waveform.codes)
+    deltas[0:1] = waveform.codes[0:1]
+    deltas[1:] = waveform.codes[1:] - waveform.codes[:-1]
+    numpy.savez_compressed(
+            archiveFile,
+            deltas=deltas,
+            y_zero=waveform.y_zero,
+            y_resolution=waveform.y_resolution,
+            overload=waveform.overload,
+            underload=waveform.underload,
+            invalid=waveform.invalid,
+            channel=waveform.channel,
+            trace_type=waveform.trace_type,
+            y_unit=waveform.y_unit,
+            x_unit=waveform.x_unit,
+            y_divisions=waveform.y_divisions,
+            x_divisions=waveform.x_divisions,
+            y_scale=waveform.y_scale,
+            x_scale=waveform.x_scale,
+            x_zero=waveform.x_zero,
+            y_at_0=waveform.y_at_0,
+            delta_x=waveform.delta_x,
+            timestamp=waveform.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            title=waveform.title)
+
+def archiveRead(filename, decode=True):
+    archive = numpy.load(filename)
+
+    waveform = waveform_t()
+    deltas = archive['deltas']
+    waveform.codes = numpy.cumsum(deltas, axis=0, dtype=deltas.dtype)
+    for name in ['channel', 'trace_type', 'y_unit', 'x_unit', 'title']:
+        setattr(waveform, name, str(archive[name]))
+    for name in ['y_divisions', 'x_divisions', 'overload', 'underload', 'invalid']:
+        setattr(waveform, name, int(archive[name]))
+    for name in [
+            'y_zero',
+            'y_resolution',
+            'y_scale',
+            'x_scale',
+            'x_zero',
+            'y_at_0',
+            'delta_x']:
+        setattr(waveform, name, float(archive[name]))
+    waveform.timestamp = datetime.datetime.strptime(
+            str(archive['timestamp']),
+            "%Y-%m-%d %H:%M:%S")
+    archive.close()
+
+    if decode:
+        waveform.samples = decodeSamples(waveform)
+
+    return waveform
 
 units = [
         None,
@@ -344,7 +1442,7 @@ def si(number, precision, unit):
         degree_var = degree(number)
         if precision != 0:
             significantDigits = \
-                    math.floor(math.log10(number)) \
+                    math.floor(math.log10(abs(number))) \
                     -math.floor(math.log10(precision)) \
                     +1
             significantDigits -= int(
@@ -417,123 +1515,876 @@ def formatSeconds(seconds):
         output=output+" ({:.3f} seconds)".format(totalSeconds)
     return output
 
-def waveform(port, source):
-    print("Downloading waveform admin data from ScopeMeter...", end="", flush=True)
-    sendCommand(port, "QW "+source)
-
-    # Handle the administrative data
-    header, size = getHeader(port, 2)
-
-    if size != 47:
-        print("error: admin data is a weird size ({:d})".format(size))
-        exit(1)
-
-    #if header != 0:
-    #    print("error: received admin data but no samples ({:d})".format(header))
-    #    exit(1)
-
-    data = getData(port, size)
-
+def waveform(meter, source):
+    print("Downloading waveform from ScopeMeter...", end="", flush=True)
+    with phase("transfer QW"):
+        data = meter.waveform(source)
     print("done")
-    print("Processing waveform admin data from ScopeMeter...", end="", flush=True)
-
-    waveform = waveform_t()
 
-    waveform.y_unit = units[data[1]]
-    waveform.x_unit = units[data[2]]
-    waveform.y_divisions = getUInt(data[3:5])
-    waveform.x_divisions = getUInt(data[5:7])
-    waveform.y_scale = getFloat(data[7:10])
-    waveform.x_scale = getFloat(data[10:13])
-    y_zero = getFloat(data[15:18])
-    waveform.x_zero = getFloat(data[18:21])
-    y_resolution = getFloat(data[21:24])
-    waveform.delta_x = getFloat(data[24:27])
-    waveform.y_at_0 = getFloat(data[27:30])
-    waveform.timestamp = datetime.datetime(
-            int(data[33:37].decode('ascii')),
-            int(data[37:39].decode('ascii')),
-            int(data[39:41].decode('ascii')),
-            int(data[41:43].decode('ascii')),
-            int(data[43:45].decode('ascii')),
-            int(data[45:47].decode('ascii')))
+    if meter.filter != None:
+        with phase("filter"):
+            filterApply(meter.filter, source, data)
+
+    return data
+
+def datWrite(datFile, waveform):
+    for j in range(waveform.samples.shape[0]):
+        datFile.write("{:.5e}".format(waveform.x_zero+j*waveform.delta_x))
+        for k in range(waveform.samples.shape[1]):
+            datFile.write(" {:.5e}".format(waveform.samples[j][k]))
+        if waveform.uncertainty is not None and waveform.samples.shape[1] == 1:
+            datFile.write(" {:.5e} {:.5e} {:.5e} {:.5e}".format(
+                waveform.samples[j][0]-waveform.uncertainty[j][0],
+                waveform.samples[j][0]+waveform.uncertainty[j][0],
+                waveform.minimum[j][0],
+                waveform.maximum[j][0]))
+        datFile.write("\n")
+
+def harmonicsWrite(datFile, analysis):
+    for j in range(len(analysis.orders)):
+        datFile.write("{:d} {:.5e} {:.5e} {:.5e} {:.5e} {:.5e}\n".format(
+            analysis.orders[j],
+            analysis.orders[j]*analysis.frequency,
+            abs(analysis.voltage[j]),
+            numpy.degrees(numpy.angle(analysis.voltage[j])),
+            abs(analysis.current[j]),
+            numpy.degrees(numpy.angle(analysis.current[j]))))
+
+def waveformFilename(waveform):
+    return waveform.timestamp.strftime("%Y-%m-%d-%H-%M-%S") \
+            + "_input-" + waveform.channel \
+            + "_" + waveform.trace_type.lower().replace(' ', '-') \
+            + "_" + waveform.x_unit \
+            + "-vs-" + waveform.y_unit.replace('/', 'per')
+
+def dataFilename(waveform):
+    if waveform.trace_type == 'spectrogram':
+        return waveform.filename+".spg"
+    return waveform.filename+".dat"
+
+def captures(meter, source, count=None):
+    filterReset(meter.filter)
+    number = 0
+    while count == None or number < count:
+        yield waveform(meter, source)
+        number += 1
+
+class filter_t:
+    spec = ""
+    stages = None
+    sos = None
+    state = None
+
+def filterParse(spec):
+    filter = filter_t()
+    filter.spec = spec
+    filter.stages = []
+    filter.sos = {}
+    filter.state = {}
+    for stage in spec.split(','):
+        name, equals, value = stage.strip().partition('=')
+        try:
+            if name == 'dc' and not equals:
+                value = 0.5
+            if name not in ['notch', 'lowpass', 'highpass', 'dc']:
+                raise ValueError
+            filter.stages.append((name, float(value)))
+        except ValueError:
+            print("error: bad filter stage “{:s}”".format(stage.strip()))
+            exit(1)
+    return filter
+
+def filterDesign(stages, delta_x):
+    rate = 1/delta_x
+    sections = []
+    for name, frequency in stages:
+        if not 0 < frequency < rate/2:
+            print("warning: {:s} at {:g} Hz is out of reach sampling at {:g} Hz, "
+                    "not filtering at this time base".format(name, frequency, rate))
+            return None
+        if name == 'notch':
+            b, a = scipy.signal.iirnotch(frequency, 30, rate)
+            sections.append(scipy.signal.tf2sos(b, a))
+        elif name == 'lowpass':
+            sections.append(scipy.signal.butter(4, frequency, 'lowpass', fs=rate, output='sos'))
+        elif name == 'highpass':
+            sections.append(scipy.signal.butter(4, frequency, 'highpass', fs=rate, output='sos'))
+        elif name == 'dc':
+            sections.append(scipy.signal.butter(1, frequency, 'highpass', fs=rate, output='sos'))
+    return numpy.concatenate(sections)
+
+def filterReset(filter):
+    # Captures only follow on from one another within a stream of them
+    if filter != None:
+        filter.state = {}
+
+def filterApply(filter, source, data):
+    # Each source has its own filter state, carried from one capture to
+    # the next of a stream so it is filtered without a fresh transient at
+    # every start. Trends (sources 11, 21...) have a time base of their own.
+    if data.x_unit != 's' or source[-1] == '1':
+        return
+    if data.delta_x not in filter.sos:
+        filter.sos[data.delta_x] = filterDesign(filter.stages, data.delta_x)
+    sos = filter.sos[data.delta_x]
+    if sos is None:
+        return
 
-    print("done")
-    print("Downloading waveform sample data from ScopeMeter...", end="", flush=True)
+    # Sentinels would poison the state, so they are bridged over on the
+    # way in and put back on the way out
+    valid = numpy.isfinite(data.samples)
+    x = numpy.column_stack([fillGaps(column) for column in data.samples.T])
+    if not numpy.isfinite(x).all():
+        return
+    key = (data.delta_x, x.shape[1])
+    if source not in filter.state or filter.state[source][0] != key:
+        # Start as if the first sample had always been there
+        filter.state[source] = (key, scipy.signal.sosfilt_zi(sos)[:, :, None] * x[0])
+    y, state = scipy.signal.sosfilt(sos, x, axis=0, zi=filter.state[source][1])
+    filter.state[source] = (key, state)
+    data.samples = numpy.where(valid, y, data.samples)
+    data.filtered = filter.spec
+
+class spectrogram_t:
+    waveform = None
+    spgFile = None
+    segment = 0
+    hop = 0
+    window = None
+    scale = 0.0
+    columns = 0
+    tile = []
+    tileSize = 64
+
+def spectrogramOpen(first, segment=256):
+    spectrogram = spectrogram_t()
+    size = first.samples.shape[0]
+    spectrogram.segment = int(min(2**math.floor(math.log2(size)), segment))
+    spectrogram.hop = spectrogram.segment//2
+    spectrogram.window = scipy.signal.get_window(
+            "hamming",
+            spectrogram.segment)
+    spectrogram.scale = first.delta_x/(spectrogram.window**2).sum()
+    spectrogram.tile = []
+
+    data = waveform_t()
+    data.channel = first.channel
+    data.trace_type = "spectrogram"
+    data.window_type = "hamming"
+    data.window_size = spectrogram.segment
+    data.y_unit = "dB"+first.y_unit+"²/Hz"
+    data.x_unit = first.x_unit
+    data.x_zero = first.x_zero
+    data.delta_x = first.delta_x
+    data.timestamp = first.timestamp
+    data.filename = waveformFilename(data)
+    spectrogram.waveform = data
+
+    # Laid out as a gnuplot binary matrix: a row of frequencies, then one
+    # row per segment holding its time and spectral density. Rows only
+    # ever get appended, so it can grow for as long as captures arrive.
+    frequencies = numpy.fft.rfftfreq(spectrogram.segment, first.delta_x)
+    spectrogram.spgFile = open(data.filename+".spg", 'wb')
+    spectrogram.spgFile.write(numpy.concatenate(
+        [[len(frequencies)], frequencies]).astype(numpy.float32).tobytes())
+
+    return spectrogram
+
+def spectrogramFlush(spectrogram):
+    if len(spectrogram.tile):
+        spectrogram.spgFile.write(
+                numpy.concatenate(spectrogram.tile).astype(numpy.float32).tobytes())
+        spectrogram.spgFile.flush()
+        spectrogram.tile = []
+
+def spectrogramFeed(spectrogram, data):
+    if data.delta_x != spectrogram.waveform.delta_x:
+        raise ValueError("time base changed during spectrogram")
+
+    x = fillGaps(data.samples.mean(axis=1))
+    if x.shape[0] < spectrogram.segment:
+        return
 
-    # Get our comma separator
-    byte = port.read()
-    if not (len(byte) == 1 and byte[0] == ord(',')):
-        print("error: invalid separator between admin and samples")
+    frames = numpy.lib.stride_tricks.sliding_window_view(
+            x,
+            spectrogram.segment)[::spectrogram.hop]
+    frames = frames - frames.mean(axis=1)[:, None]
+    density = abs(numpy.fft.rfft(frames*spectrogram.window, axis=1))**2 \
+            * spectrogram.scale
+    density[:, 1:(spectrogram.segment+1)//2] *= 2
+
+    start = (data.timestamp-spectrogram.waveform.timestamp).total_seconds() \
+            + data.x_zero
+    times = start + data.delta_x*(
+            numpy.arange(frames.shape[0])*spectrogram.hop
+            + spectrogram.segment/2)
+
+    spectrogram.tile.append(numpy.column_stack(
+        [times, 10*numpy.log10(numpy.maximum(density, 1e-30))]))
+    spectrogram.columns += frames.shape[0]
+    if sum([rows.shape[0] for rows in spectrogram.tile]) >= spectrogram.tileSize:
+        spectrogramFlush(spectrogram)
+
+def spectrogramClose(spectrogram):
+    spectrogramFlush(spectrogram)
+    spectrogram.spgFile.close()
+
+    # Each row of the spectrogram counts as a sample, but there is
+    # nothing to hold in memory
+    spectrogram.waveform.samples = numpy.empty([spectrogram.columns, 0])
+    return spectrogram.waveform
+
+def spectrogram(meter, source):
+    count = input("How many captures (blank to stop with Ctrl-C)? ")
+    count = int(count) if len(count) else None
+
+    stream = None
+    number = 0
+    try:
+        for data in captures(meter, source, count):
+            data.channel = chr(ord('A')+int(source[0])-1)
+            if stream == None:
+                stream = spectrogramOpen(data)
+            with phase("spectrogram"):
+                spectrogramFeed(stream, data)
+            number += 1
+    except KeyboardInterrupt:
+        print("\nStopped after {:d} captures".format(number))
+        meter.port.reset_input_buffer()
+    except ValueError as error:
+        print("error: "+str(error))
+        exit(1)
+    if stream == None:
+        print("error: no captures for spectrogram")
         exit(1)
 
-    # Handle the sample data
-    header, size = getHeader(port, 4)
-    #if header != 129:
-    #    print("error: invalid header ({:d}) in sample data".format(header))
-    #    exit(1)
-    data = getData(port, size)
-
-    terminator = port.read(1)
-    if len(terminator) != 1 and terminator[0] != ord('\r'):
-        print("error: got invalid terminator to trace data")
-
-    print("done")
-    print("Processing waveform sample data from ScopeMeter...", end="", flush=True)
-
-    getNumber = getUInt
-    if data[0]&0b10000000 != 0:
-        getNumber = getInt
-    sample_size =    data[0]&0b00000111
-    samples_per_sample = 1
-
-    if data[0]&0b01110000 == 0b01000000:
-        samples_per_sample = 2
-    if data[0]&0b01110000 == 0b01100000:
-        samples_per_sample = 3
-    if data[0]&0b01110000 == 0b01110000:
-        if "trend" in waveform.trace_type:
-            samples_per_sample = 3
+    return spectrogramClose(stream)
+
+class pyramid_t:
+    waveform = None
+    directory = ""
+    trend = False
+    factor = 16
+    depth = 8
+    levels = []
+    carry = []
+    last = None
+
+pyramidRow = numpy.dtype([
+        ('t', '<f8'),
+        ('min', '<f4'),
+        ('max', '<f4'),
+        ('mean', '<f4')])
+
+def pyramidOpen(first, trend=False, factor=16, depth=8):
+    pyramid = pyramid_t()
+    pyramid.trend = trend
+    pyramid.factor = factor
+    pyramid.depth = depth
+
+    data = waveform_t()
+    data.channel = first.channel
+    data.trace_type = "pyramid"
+    data.y_unit = first.y_unit
+    data.x_unit = first.x_unit
+    data.y_divisions = first.y_divisions
+    data.x_divisions = first.x_divisions
+    data.y_scale = first.y_scale
+    data.y_at_0 = first.y_at_0
+    data.delta_x = first.delta_x
+    data.timestamp = first.timestamp
+    data.filename = waveformFilename(data)
+    pyramid.waveform = data
+
+    # Level n holds one row per factor**n sample periods, each row being
+    # the time, minimum, maximum and mean of what fell into it. Rows only
+    # ever get appended, so a logging run can go on for days.
+    pyramid.directory = data.filename+".pyramid"
+    os.makedirs(pyramid.directory, exist_ok=True)
+    with open(os.path.join(pyramid.directory, "index.json"), 'w') as indexFile:
+        json.dump({
+                "factor": factor,
+                "depth": depth,
+                "channel": data.channel,
+                "y_unit": data.y_unit,
+                "x_unit": data.x_unit,
+                "y_divisions": data.y_divisions,
+                "x_divisions": data.x_divisions,
+                "y_scale": data.y_scale,
+                "y_at_0": data.y_at_0,
+                "delta_x": data.delta_x,
+                "timestamp": data.timestamp.strftime("%Y-%m-%d %H:%M:%S")},
+            indexFile,
+            indent=1)
+    pyramid.levels = []
+    pyramid.carry = []
+    for level in range(depth):
+        pyramid.levels.append(open(os.path.join(
+            pyramid.directory,
+            "level-{:d}.bin".format(level)), 'wb'))
+        pyramid.carry.append(numpy.empty([0, 5]))
+    pyramid.last = None
+
+    return pyramid
+
+def pyramidReduce(rows, buckets, width):
+    starts = numpy.flatnonzero(numpy.diff(buckets, prepend=-numpy.inf))
+    count = numpy.add.reduceat(rows[:, 4], starts)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        total = numpy.add.reduceat(
+                numpy.where(rows[:, 4] > 0, rows[:, 3]*rows[:, 4], 0),
+                starts)
+        return numpy.column_stack([
+            buckets[starts]*width,
+            numpy.fmin.reduceat(rows[:, 1], starts),
+            numpy.fmax.reduceat(rows[:, 2], starts),
+            numpy.where(count > 0, total/count, numpy.nan),
+            count])
+
+def pyramidPush(pyramid, level, rows):
+    # Rows are time, min, max, mean and the number of valid samples
+    output = numpy.empty(rows.shape[0], pyramidRow)
+    output['t'] = rows[:, 0]
+    output['min'] = rows[:, 1]
+    output['max'] = rows[:, 2]
+    output['mean'] = rows[:, 3]
+    pyramid.levels[level].write(output.tobytes())
+
+    if level+1 == pyramid.depth:
+        return
+    rows = numpy.concatenate([pyramid.carry[level], rows])
+    width = pyramid.waveform.delta_x*pyramid.factor**(level+1)
+    buckets = numpy.floor(rows[:, 0]/width+1e-9)
+
+    # The last bucket may still grow with the next capture
+    done = buckets < buckets[-1]
+    pyramid.carry[level] = rows[~done]
+    if done.any():
+        pyramidPush(pyramid, level+1, pyramidReduce(rows[done], buckets[done], width))
+
+def pyramidFeed(pyramid, data):
+    if data.delta_x != pyramid.waveform.delta_x:
+        raise ValueError("time base changed during pyramid")
+
+    samples = data.samples
+    with numpy.errstate(invalid='ignore'):
+        low = numpy.fmin.reduce(samples, axis=1)
+        high = numpy.fmax.reduce(samples, axis=1)
+    if samples.shape[1] == 3:
+        # The median of min/max/average is the average
+        mean = numpy.median(samples, axis=1)
+    else:
+        mean = rowMean(samples)
+
+    start = (data.timestamp-pyramid.waveform.timestamp).total_seconds() \
+            + data.x_zero
+    if pyramid.last != None:
+        if pyramid.trend:
+            # Every trend download repeats what was logged so far
+            skip = max(0, math.ceil((pyramid.last-start)/data.delta_x+0.5))
+            samples = samples[skip:]
+            low, high, mean = low[skip:], high[skip:], mean[skip:]
+            start += skip*data.delta_x
         else:
-            samples_per_sample = 2
+            # The timestamp only has whole seconds, but captures follow
+            # one another
+            start = max(start, pyramid.last+data.delta_x)
+    if samples.shape[0] == 0:
+        return
 
-    pointer = 1
-    overload = getNumber(data[pointer:pointer+sample_size])
-    pointer += sample_size
-    underload = getNumber(data[pointer:pointer+sample_size])
-    pointer += sample_size
-    invalid = getNumber(data[pointer:pointer+sample_size])
-    pointer += sample_size
-    nbr_of_samples = getUInt(data[pointer:pointer+2])
-    pointer += 2
+    times = start + data.delta_x*numpy.arange(samples.shape[0])
+    pyramidPush(pyramid, 0, numpy.column_stack([
+        times,
+        low,
+        high,
+        mean,
+        numpy.isfinite(mean).astype(float)]))
+    pyramid.last = times[-1]
+    for levelFile in pyramid.levels:
+        levelFile.flush()
+
+def pyramidClose(pyramid):
+    # Whatever is left in the unfinished buckets becomes their final row
+    for level in range(pyramid.depth-1):
+        rows = pyramid.carry[level]
+        pyramid.carry[level] = numpy.empty([0, 5])
+        if rows.shape[0]:
+            width = pyramid.waveform.delta_x*pyramid.factor**(level+1)
+            buckets = numpy.floor(rows[:, 0]/width+1e-9)
+            pyramidPush(pyramid, level+1, pyramidReduce(rows, buckets, width))
+    for levelFile in pyramid.levels:
+        levelFile.close()
+
+    return pyramidRead(pyramid.directory)
+
+def pyramidLevel(directory, start, end, points=2000):
+    with open(os.path.join(directory, "index.json")) as indexFile:
+        index = json.load(indexFile)
+    # The finest level that keeps the span within the number of points
+    level = 0
+    while level+1 < index["depth"] and \
+            (end-start)/(index["delta_x"]*index["factor"]**level) > points:
+        level += 1
+    return level
+
+def pyramidRead(directory, start=None, end=None, points=2000):
+    with open(os.path.join(directory, "index.json")) as indexFile:
+        index = json.load(indexFile)
+
+    def rows(level):
+        filename = os.path.join(directory, "level-{:d}.bin".format(level))
+        if os.path.getsize(filename) < pyramidRow.itemsize:
+            return numpy.empty(0, pyramidRow)
+        return numpy.memmap(filename, pyramidRow, 'r')
+
+    if start == None or end == None:
+        finest = rows(0)
+        if start == None:
+            start = float(finest['t'][0]) if len(finest) else 0.0
+        if end == None:
+            end = float(finest['t'][-1])+index["delta_x"] if len(finest) else 0.0
+
+    level = pyramidLevel(directory, start, end, points)
+    width = index["delta_x"]*index["factor"]**level
+    origin = math.floor(start/width+1e-9)*width
+    size = max(1, math.ceil((end-origin)/width-1e-9))
+
+    # Only the rows in the span are paged in from the level
+    levelRows = rows(level)
+    first = numpy.searchsorted(levelRows['t'], origin-width/2)
+    last = numpy.searchsorted(levelRows['t'], origin+size*width-width/2)
+    view = levelRows[first:last]
+    positions = numpy.clip(numpy.round((view['t']-origin)/width).astype(int), 0, size-1)
+
+    data = waveform_t()
+    data.channel = index["channel"]
+    data.trace_type = "pyramid"
+    data.y_unit = index["y_unit"]
+    data.x_unit = index["x_unit"]
+    data.y_divisions = index["y_divisions"]
+    data.x_divisions = index["x_divisions"] or 10
+    data.y_scale = index["y_scale"]
+    data.y_at_0 = index["y_at_0"]
+    data.x_zero = origin
+    data.delta_x = width
+    data.x_scale = size*width/data.x_divisions
+    data.timestamp = datetime.datetime.strptime(
+            index["timestamp"],
+            "%Y-%m-%d %H:%M:%S")
+    data.samples = numpy.full([size, 3], numpy.nan)
+    data.samples[positions, 0] = view['min']
+    data.samples[positions, 1] = view['max']
+    data.samples[positions, 2] = view['mean']
+
+    return data
+
+def pyramid(meter):
+    kind = ""
+    while kind not in ['a', 'b', 'c']:
+        kind = input("Log (a) traces, (b) envelopes or (c) trends? ")[:1]
+    source = {'a': "10", 'b': "12", 'c': "11"}[kind]
+    count = input("How many captures (blank to stop with Ctrl-C)? ")
+    count = int(count) if len(count) else None
+
+    stream = None
+    number = 0
+    try:
+        for data in captures(meter, source, count):
+            data.channel = 'A'
+            if stream == None:
+                stream = pyramidOpen(data, source[-1] == '1')
+            with phase("pyramid"):
+                pyramidFeed(stream, data)
+            number += 1
+    except KeyboardInterrupt:
+        print("\nStopped after {:d} captures".format(number))
+        meter.port.reset_input_buffer()
+    except ValueError as error:
+        print("error: "+str(error))
+        exit(1)
+    if stream == None:
+        print("error: no captures for pyramid")
+        exit(1)
 
-    waveform.samples = numpy.empty([nbr_of_samples, samples_per_sample])
-    
-    for i in range(nbr_of_samples):
-        for j in range(samples_per_sample):
-            sample = getNumber(data[pointer:pointer+sample_size])
-            if sample == overload:
-                waveform.samples[i][j] = numpy.inf
-            elif sample == underload:
-                waveform.samples[i][j] = -numpy.inf
-            elif sample == invalid:
-                waveform.samples[i][j] = numpy.nan
+    return pyramidClose(stream)
+
+class trigger_t:
+    level = None
+    slope = "either"
+    runt = None
+    glitch = None
+    sentinels = None
+    rms = None
+    pre = 1
+    post = 1
+    baseline = None
+
+def triggerParse(conditions, context="1,1"):
+    trigger = trigger_t()
+    try:
+        for condition in conditions.split(','):
+            name, equals, value = condition.strip().partition('=')
+            if name == 'level':
+                trigger.level = float(value)
+            elif name == 'slope' and value in ['rising', 'falling', 'either']:
+                trigger.slope = value
+            elif name == 'runt':
+                low, high = [float(level) for level in value.split(':')]
+                trigger.runt = (min(low, high), max(low, high))
+            elif name == 'glitch':
+                trigger.glitch = float(value)
+            elif name == 'sentinels':
+                trigger.sentinels = int(value)
+            elif name == 'rms':
+                trigger.rms = float(value)
             else:
-                waveform.samples[i][j] = y_zero + sample*y_resolution
-            pointer += sample_size
-
-    if pointer != size:
-        print("error: number of samples does not match block size")
+                raise ValueError
+        trigger.pre, trigger.post = [int(frames) for frames in context.split(',')]
+    except ValueError:
+        print("error: bad trigger condition “{:s}”".format(condition.strip()))
+        exit(1)
+    if trigger.pre < 0 or trigger.post < 0:
+        print("error: trigger context must not be negative")
+        exit(1)
+    return trigger
+
+def triggerCheck(trigger, data):
+    reasons = []
+    samples = data.samples
+    x = fillGaps(rowMean(samples))
+    usable = numpy.isfinite(x).all()
+
+    if trigger.level != None and usable:
+        # Captures do not follow on from one another, so only edges within
+        # one count
+        above = x >= trigger.level
+        rising = numpy.count_nonzero(~above[:-1] & above[1:])
+        falling = numpy.count_nonzero(above[:-1] & ~above[1:])
+        if trigger.slope != "falling" and rising:
+            reasons.append("{:d} rising through {:g}".format(rising, trigger.level))
+        if trigger.slope != "rising" and falling:
+            reasons.append("{:d} falling through {:g}".format(falling, trigger.level))
+
+    if trigger.runt != None and usable:
+        # Which band each sample is in, collapsed to the bands visited: a
+        # runt leaves one outer band and returns without reaching the other
+        low, high = trigger.runt
+        bands = numpy.where(x <= low, -1, numpy.where(x >= high, 1, 0))
+        bands = bands[numpy.concatenate([[True], bands[1:] != bands[:-1]])]
+        runts = numpy.count_nonzero(
+                (bands[1:-1] == 0) & (bands[:-2] == bands[2:]))
+        if runts:
+            reasons.append("{:d} runts".format(runts))
+
+    if trigger.glitch != None and samples.shape[1] == 2:
+        with numpy.errstate(invalid='ignore'):
+            glitches = numpy.count_nonzero(
+                    abs(samples[:, 1]-samples[:, 0]) >= trigger.glitch)
+        if glitches:
+            reasons.append("{:d} glitches".format(glitches))
+
+    if trigger.sentinels != None:
+        sentinels = numpy.count_nonzero(~numpy.isfinite(samples).all(axis=1))
+        if sentinels >= trigger.sentinels:
+            reasons.append("{:d} overload, underload or invalid".format(sentinels))
+
+    valid = numpy.isfinite(samples)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        rms = math.sqrt((numpy.where(valid, samples, 0)**2).sum()/valid.sum())
+        if trigger.rms != None and trigger.baseline != None:
+            change = abs(rms-trigger.baseline)/trigger.baseline
+            if change > trigger.rms:
+                reasons.append("RMS {:+.1f}% of baseline".format(
+                    100*(rms-trigger.baseline)/trigger.baseline))
+
+    # The baseline follows the uneventful captures only
+    if not reasons and math.isfinite(rms):
+        if trigger.baseline == None:
+            trigger.baseline = rms
+        else:
+            trigger.baseline += (rms-trigger.baseline)/8
+
+    return reasons, rms
+
+def triggered(meter, source, trigger=None):
+    if trigger == None:
+        trigger = triggerParse(input(
+            "Trigger on (level=V,slope=rising|falling|either,runt=LOW:HIGH,"
+            "glitch=V,sentinels=N,rms=FRACTION)? "))
+    trigger.baseline = None
+    count = input("How many captures (blank to stop with Ctrl-C)? ")
+    count = int(count) if len(count) else None
+
+    data = None
+    directory = None
+    context = collections.deque(maxlen=trigger.pre)
+    events = []
+    post = 0
+    times = []
+    levels = []
+    number = 0
+    hits = 0
+    total = 0
+    stored = 0
+    try:
+        for frame in captures(meter, source, count):
+            frame.channel = chr(ord('A')+int(source[0])-1)
+            if data == None:
+                data = waveform_t()
+                data.channel = frame.channel
+                data.trace_type = "triggered"
+                data.y_unit = frame.y_unit
+                data.x_unit = "s"
+                data.timestamp = frame.timestamp
+                data.filename = waveformFilename(data)
+                directory = data.filename+".frames"
+                os.makedirs(directory, exist_ok=True)
+            with phase("trigger"):
+                reasons, rms = triggerCheck(trigger, frame)
+            times.append((frame.timestamp-data.timestamp).total_seconds())
+            levels.append(rms)
+            total += frame.codes.nbytes
+
+            # Captures before a trigger wait in the context queue until
+            # one fires, then go to disk with it
+            keep = []
+            if len(reasons):
+                hits += 1
+                keep = list(context)+[(number, frame, reasons)]
+                context.clear()
+                post = trigger.post
+            elif post > 0:
+                keep = [(number, frame, reasons)]
+                post -= 1
+            elif trigger.pre:
+                context.append((number, frame, reasons))
+            for kept, keptFrame, keptReasons in keep:
+                classifyTrace(keptFrame)
+                name = "{:06d}_{:s}".format(kept, waveformFilename(keptFrame))
+                writeBehind(
+                        os.path.join(directory, name+".npz"),
+                        'wb',
+                        archiveWrite,
+                        keptFrame)
+                stored += keptFrame.codes.nbytes
+                events.append({
+                    "capture": kept,
+                    "file": name+".npz",
+                    "timestamp": keptFrame.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                    "reasons": keptReasons})
+            if len(reasons):
+                print("Trigger on capture {:d}: {:s}".format(number, ", ".join(reasons)))
+            number += 1
+    except KeyboardInterrupt:
+        print("\nStopped after {:d} captures".format(number))
+        meter.port.reset_input_buffer()
+    if data == None:
+        print("error: no captures for trigger")
         exit(1)
-    print("done")
-
-    return waveform
 
-def waveforms(port):
+    print("Kept {:d} of {:d} captures for {:d} triggers, discarding {:.1f}% "
+            "of the sample data".format(
+                len(events),
+                number,
+                hits,
+                100*(1-stored/total) if total else 0.0))
+    with open(os.path.join(directory, "index.json"), 'w') as indexFile:
+        json.dump({
+                "conditions": {
+                    "level": trigger.level,
+                    "slope": trigger.slope,
+                    "runt": trigger.runt,
+                    "glitch": trigger.glitch,
+                    "sentinels": trigger.sentinels,
+                    "rms": trigger.rms},
+                "pre": trigger.pre,
+                "post": trigger.post,
+                "captures": number,
+                "triggers": hits,
+                "bytes": total,
+                "stored": stored,
+                "kept": events},
+            indexFile,
+            indent=1)
+
+    # The RMS of every capture, whether kept or not, as a trend over the
+    # run; captures follow one another at a roughly even pace
+    data.samples = numpy.array(levels)[:, None]
+    data.delta_x = (times[-1]-times[0])/(len(times)-1) if times[-1] > times[0] else 1.0
+    data.x_divisions = 10
+    data.x_scale = data.delta_x*len(times)/data.x_divisions
+
+    # Nothing from the meter says how to scale it: 8 divisions of 1, 2 or
+    # 5 times a power of ten from 0 up past the largest RMS
+    largest = numpy.nanmax(data.samples) if numpy.isfinite(data.samples).any() else 0
+    data.y_divisions = 8
+    data.y_at_0 = 0.0
+    data.y_scale = 1.0
+    if largest > 0:
+        decade = 10.0**math.floor(math.log10(largest/data.y_divisions))
+        data.y_scale = min([step*decade for step in [1, 2, 5, 10]
+                if step*decade*data.y_divisions >= largest])
+    return data
+
+class running_t:
+    count = None
+    mean = None
+    m2 = None
+    minimum = None
+    maximum = None
+
+def runningUpdate(running, samples):
+    if running.count is None:
+        running.count = numpy.zeros(samples.shape, numpy.int64)
+        running.mean = numpy.zeros(samples.shape)
+        running.m2 = numpy.zeros(samples.shape)
+        running.minimum = numpy.full(samples.shape, numpy.nan)
+        running.maximum = numpy.full(samples.shape, numpy.nan)
+    if samples.shape != running.count.shape:
+        raise ValueError("waveform size changed while averaging")
+
+    # Welford's update, skipping samples that are overloaded or invalid
+    finite = numpy.isfinite(samples)
+    running.count += finite
+    with numpy.errstate(invalid='ignore'):
+        delta = numpy.where(finite, samples-running.mean, 0)
+        running.mean += delta/numpy.maximum(running.count, 1)
+        running.m2 += numpy.where(finite, delta*(samples-running.mean), 0)
+    # Overload and underload still widen the envelope
+    running.minimum = numpy.fmin(running.minimum, samples)
+    running.maximum = numpy.fmax(running.maximum, samples)
+
+def runningResult(running, template):
+    data = copy.copy(template)
+    data.codes = None
+    data.averaged = True
+
+    count = running.count
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        data.samples = numpy.where(count > 0, running.mean, numpy.nan)
+        # Standard error of the mean
+        data.uncertainty = numpy.where(
+                count > 1,
+                numpy.sqrt(running.m2/(count-1)/count),
+                numpy.nan)
+    # Samples that were never valid keep their sentinel
+    data.samples[(count == 0) & (running.maximum == numpy.inf)] = numpy.inf
+    data.samples[(count == 0) & (running.minimum == -numpy.inf)] = -numpy.inf
+    data.minimum = running.minimum
+    data.maximum = running.maximum
+
+    return data
+
+def averageWaveform(meter, source, count):
+    running = running_t()
+    number = 0
+    for data in captures(meter, source, count):
+        number += 1
+        print("Averaged capture {:d} of {:d}".format(number, count))
+        with phase("averaging"):
+            try:
+                runningUpdate(running, data.samples)
+            except ValueError as error:
+                print("error: "+str(error))
+                exit(1)
+    return runningResult(running, data)
+
+def classifyTrace(data):
+    if data.samples.shape[1] == 2:
+        matching = True
+        for i in data.samples:
+            if i[0] != i[1]:
+                matching = False
+                break
+        if matching:
+            samples = numpy.empty([data.samples.shape[0], 1])
+            for i in range(samples.shape[0]):
+                samples[i][0] = data.samples[i][0]
+            data.samples = samples
+            if data.codes is not None:
+                data.codes = data.codes[:, 0:1]
+            if data.averaged:
+                data.uncertainty = data.uncertainty[:, 0:1]
+                data.minimum = numpy.fmin(
+                        data.minimum[:, 0:1],
+                        data.minimum[:, 1:2])
+                data.maximum = numpy.fmax(
+                        data.maximum[:, 0:1],
+                        data.maximum[:, 1:2])
+            data.trace_type = "average"
+        else:
+            data.trace_type = "glitch"
+    else:
+        data.trace_type = "trace"
+
+def powerWaveform(voltage, current):
+    analysis = powerQuality([(voltage, current)])[0]
+    data = waveform_t()
+    data.channel = "both"
+    if voltage.trace_type != 'trace':
+        data.trace_type = voltage.trace_type + ' '
+    data.trace_type += "power"
+    data.y_unit = "W"
+    data.x_unit = voltage.x_unit
+    data.y_divisions = voltage.y_divisions
+    data.x_divisions = voltage.x_divisions
+    data.y_scale = voltage.y_scale * voltage.y_scale
+    data.x_scale = voltage.x_scale
+    data.x_zero = voltage.x_zero
+    data.y_at_0 = voltage.y_at_0 * current.y_at_0
+    data.delta_x = voltage.delta_x
+    data.timestamp = voltage.timestamp
+    data.samples = voltage.samples
+    for i in range(data.samples.shape[0]):
+        data.samples[i] = voltage.samples[i] * current.samples[i]
+    data.averaged = voltage.averaged
+    data.analysis = analysis
+    return data
+
+def psdWaveform(source):
+    x = numpy.empty(source.samples.shape[0])
+    for i in range(x.shape[0]):
+        x[i] = source.samples[i][0]
+    segsize = int(min(int(2**math.floor(math.log2(len(x)))), 2048))
+    frequency, power = scipy.signal.welch(
+            x = x,
+            fs = 1.0/source.delta_x,
+            window = "hamming",
+            nperseg = segsize,
+            noverlap = 3*segsize/4,
+            return_onesided = True)
+
+    data = waveform_t()
+    data.window_type = "hamming"
+    data.window_size = segsize
+    data.trace_type = 'psd'
+    if source.y_unit == 'W':
+        data.y_unit = 'dBW/Hz'
+        data.channel = 'both'
+    else:
+        data.y_unit = 'dBV²/Hz'
+        data.channel = 'A'
+    data.x_unit = 'Hz'
+    data.y_division = None
+    data.x_division = None
+    data.y_scale = None
+    data.x_scale = None
+    data.x_zero = frequency[0]
+    data.y_at_0 = None
+    data.delta_x = (frequency[-1]-frequency[0])/(len(frequency)-1)
+    data.timestamp = source.timestamp
+    data.analysis = source.analysis
+    data.samples = numpy.empty([power.shape[0], 1])
+    for i in range(power.shape[0]):
+        data.samples[i][0] = 10*math.log10(power[i])
+    return data
+
+def waveforms(meter, raw=False, average=1, trigger=None):
+    filterReset(meter.filter)
     waveforms = []
 
     waveform_type = -1
-    while waveform_type<0 or waveform_type>9:
+    while waveform_type<0 or waveform_type>12:
         print(" (a) single trace")
         print(" (b) single psd")
         print(" (c) single envelope")
@@ -543,14 +2394,27 @@ def waveforms(port):
         print(" (g) dual envelope")
         print(" (h) dual trend")
         print(" (i) dual power")
-        print(" (j) quit")
+        print(" (j) single spectrogram")
+        print(" (k) single pyramid")
+        print(" (l) single triggered")
+        print(" (m) quit")
         waveform_type = input("What type of waveform will this be? ")
         waveform_type = ord(waveform_type[0])-ord('a')
-    if waveform_type == 9:
+    if waveform_type == 12:
         return;
+    if waveform_type == 9:
+        data = spectrogram(meter, "10")
+        data.title = input("Enter title for waveform #0: ")
+        return [data]
     waveform_count = 1
     if waveform_type > 3:
         waveform_count = 2
+    if waveform_type == 10:
+        waveforms.append(pyramid(meter))
+        waveform_count = 0
+    if waveform_type == 11:
+        waveforms.append(triggered(meter, "10", trigger))
+        waveform_count = 0
     
     trace_type = ""
     source = "0"
@@ -573,29 +2437,20 @@ def waveforms(port):
     for waveform_number in range(waveform_count):
         source = "{:d}{:s}".format(waveform_number+1, source[1])
 
-        data = waveform(port, source)
+        if average > 1:
+            data = averageWaveform(meter, source, average)
+        else:
+            data = waveform(meter, source)
         data.channel = chr(ord('A')+waveform_number)
         if waveform_type%4<2:
-            if data.samples.shape[1] == 2:
-                matching = True
-                for i in data.samples:
-                    if i[0] != i[1]:
-                        matching = False
-                        break
-                if matching:
-                    samples = numpy.empty([data.samples.shape[0], 1])
-                    for i in range(samples.shape[0]):
-                        samples[i][0] = data.samples[i][0]
-                    data.samples = samples
-                    data.trace_type = "average"
-                else:
-                    data.trace_type = "glitch"
-            else:
-                data.trace_type = "trace"
+            classifyTrace(data)
         else:
             data.trace_type = trace_type
         waveforms.append(data)
 
+    # Power and psd replace the captures, which still get archived
+    captured = list(waveforms)
+
     # We are doing a dual channel power calculation
     if waveform_type == 5 or waveform_type == 8:
         if waveforms[0].timestamp != waveforms[0].timestamp:
@@ -611,25 +2466,8 @@ def waveforms(port):
                 or waveforms[1].samples.shape[1] != 1:
             print("error: cannot do power with glitch on")
             exit(1)
-        data = waveform_t()
-        data.channel = "both"
-        if waveforms[0].trace_type != 'trace':
-            data.trace_type = waveforms[0].trace_type + ' '
-        data.trace_type += "power"
-        data.y_unit = "W"
-        data.x_unit = waveforms[0].x_unit
-        data.y_divisions = waveforms[0].y_divisions
-        data.x_divisions = waveforms[0].x_divisions
-        data.y_scale = waveforms[0].y_scale * waveforms[0].y_scale
-        data.x_scale = waveforms[0].x_scale
-        data.x_zero = waveforms[0].x_zero
-        data.y_at_0 = waveforms[0].y_at_0 * waveforms[1].y_at_0
-        data.delta_x = waveforms[0].delta_x
-        data.timestamp = waveforms[0].timestamp
-        data.samples = waveforms[0].samples
-        for i in range(data.samples.shape[0]):
-            data.samples[i] = waveforms[0].samples[i] * waveforms[1].samples[i]
-        data.averaged = waveforms[0].averaged
+        with phase("power analysis"):
+            data = powerWaveform(waveforms[0], waveforms[1])
         waveforms.clear()
         waveforms.append(data)
 
@@ -640,60 +2478,29 @@ def waveforms(port):
             for i in data.samples[0]:
                 i = math.sqrt(abs(i))
 
-        x = numpy.empty(waveforms[0].samples.shape[0])
-        for i in range(x.shape[0]):
-            x[i] = waveforms[0].samples[i][0]
-        segsize = int(min(int(2**math.floor(math.log2(len(x)))), 2048))
-        frequency, power = scipy.signal.welch(
-                x = x,
-                fs = 1.0/waveforms[0].delta_x,
-                window = "hamming",
-                nperseg = segsize,
-                noverlap = 3*segsize/4,
-                return_onesided = True)
-        
-        data = waveform_t()
-        data.window_type = "hamming"
-        data.window_size = segsize
-        data.trace_type = 'psd'
-        if waveforms[0].y_unit == 'W':
-            data.y_unit = 'dBW/Hz'
-            data.channel = 'both'
-        else:
-            data.y_unit = 'dBV²/Hz'
-            data.channel = 'A'
-        data.x_unit = 'Hz'
-        data.y_division = None
-        data.x_division = None
-        data.y_scale = None
-        data.x_scale = None
-        data.x_zero = frequency[0]
-        data.y_at_0 = None
-        data.delta_x = (frequency[-1]-frequency[0])/(len(frequency)-1)
-        data.timestamp = waveforms[0].timestamp
-        data.samples = numpy.empty([power.shape[0], 1])
-        for i in range(power.shape[0]):
-            data.samples[i][0] = 10*math.log10(power[i])
+        with phase("psd analysis"):
+            data = psdWaveform(waveforms[0])
         waveforms.clear()
         waveforms.append(data)
 
     for i in range(len(waveforms)):
-        waveforms[i].filename=waveforms[i].timestamp.strftime("%Y-%m-%d-%H-%M-%S") \
-                + "_input-" + waveforms[i].channel \
-                + "_" + waveforms[i].trace_type.lower().replace(' ', '-') \
-                + "_" + waveforms[i].x_unit \
-                + "-vs-" + waveforms[i].y_unit.replace('/', 'per')
-        datFile = open(waveforms[i].filename+".dat", 'w')
-        for j in range(waveforms[i].samples.shape[0]):
-            datFile.write("{:.5e}".format(
-                waveforms[i].x_zero+j*waveforms[i].delta_x))
-            for k in range(waveforms[i].samples.shape[1]):
-                datFile.write(" {:.5e}".format(waveforms[i].samples[j][k]))
-            datFile.write("\n")
-        datFile.close()
+        waveforms[i].filename = waveformFilename(waveforms[i])
+        with phase("dat writing"):
+            writeBehind(waveforms[i].filename+".dat", 'w', datWrite, waveforms[i])
+            if waveforms[i].analysis != None:
+                writeBehind(
+                        waveforms[i].filename+"_harmonics.dat",
+                        'w',
+                        harmonicsWrite,
+                        waveforms[i].analysis)
 
         waveforms[i].title = input("Enter title for waveform #{:d}: ".format(i))
 
+    if raw:
+        for data in captured:
+            if data.codes is not None:
+                writeBehind(waveformFilename(data)+".npz", 'wb', archiveWrite, data)
+
     return waveforms
 
 class measurement_t:
@@ -703,7 +2510,98 @@ class measurement_t:
     name = ""
     precision = 0.0
 
-def measurement(port):
+types = [
+        None,
+        "Mean",
+        "RMS",
+        "True RMS",
+        "Peak to Peak",
+        "Peak Maximum",
+        "Peak Minimum",
+        "Crest Factor",
+        "Period",
+        "Duty Cycle Negative",
+        "Duty Cycle Positive",
+        "Frequency",
+        "Pulse Width Negative",
+        "Pulse Width Positive",
+        "Phase",
+        "Diode",
+        "Continuity",
+        None,
+        "Reactive Power",
+        "Apparent Power",
+        "Real Power",
+        "Harmonic Reactive Power",
+        "Harmonic Apparent Power",
+        "Harmonic Real Power",
+        "Harmonic RMS",
+        "Displacement Power Factor",
+        "Total Power Factor",
+        "Total Harmonic Distortion",
+        "Total Harmonic Distortion with respect to Fundamental",
+        "K Factor (European)",
+        "K Factor (US)",
+        "Line Frequency",
+        "Vac PWM or Vac+dc PWM",
+        "Rise Time",
+        "Fall Time"]
+
+nos = {
+        11: "Reading 1",
+        21: "Reading 2",
+        31: "Cursor 1 Amplitude",
+        41: "Cursor 2 Amplitude",
+        53: "Cursor Maximum Amplitude",
+        54: "Cursor Average Amplitude",
+        55: "Cursor Minimum Amplitude",
+        61: "Cursor Relative Amplitude",
+        71: "Cursor Relative Time"}
+
+sources = {
+        1: "Input A",
+        2: "Input B",
+        3: "Input C",
+        4: "Input D",
+        5: "External Input",
+        12: "Input A vs Input B",
+        21: "Input B vs Input A"}
+
+def combine(first, second, measurement_type):
+    # measurement_type as in measurement(): 1 +, 2 -, 3 * and 4 /
+    measurement = copy.deepcopy(second)
+    if measurement_type < 3:
+        if measurement.unit != first.unit:
+            return None
+        if measurement_type == 1:
+            measurement.value = first.value + measurement.value
+        elif measurement_type == 2:
+            measurement.value = first.value - measurement.value
+        measurement.precision = first.precision + measurement.precision
+    else:
+        value = 0.0
+        if measurement_type == 3:
+            value = first.value * measurement.value
+            if first.unit == measurement.unit:
+                measurement.unit += '²'
+            else:
+                measurement.unit = first.unit + measurement.unit
+        elif measurement_type == 4:
+            value = first.value / measurement.value
+            if first.unit == measurement.unit:
+                measurement.unit = '%'
+            else:
+                measurement.unit = first.unit + '/' + measurement.unit
+        measurement.precision = value * (
+                measurement.precision/measurement.value
+                + first.precision/first.value)
+        measurement.value = value
+        if measurement.unit == '%':
+            measurement.value *= 100
+            measurement.precision *= 100
+    return measurement
+
+def measurement(meter):
     measurement_type = -1
     while measurement_type<0 or measurement_type>5:
         print(" (a) single")
@@ -738,93 +2636,8 @@ def measurement(port):
                 "Downloading measurement metadata from ScopeMeter...",
                 end="",
                 flush=True)
-        sendCommand(port, "QM")
-
-        types = [
-                None,
-                "Mean",
-                "RMS",
-                "True RMS",
-                "Peak to Peak",
-                "Peak Maximum",
-                "Peak Minimum",
-                "Crest Factor",
-                "Period",
-                "Duty Cycle Negative",
-                "Duty Cycle Positive",
-                "Frequency",
-                "Pulse Width Negative",
-                "Pulse Width Positive",
-                "Phase",
-                "Diode",
-                "Continuity",
-                None,
-                "Reactive Power",
-                "Apparent Power",
-                "Real Power",
-                "Harmonic Reactive Power",
-                "Harmonic Apparent Power",
-                "Harmonic Real Power",
-                "Harmonic RMS",
-                "Displacement Power Factor",
-                "Total Power Factor",
-                "Total Harmonic Distortion",
-                "Total Harmonic Distortion with respect to Fundamental",
-                "K Factor (European)",
-                "K Factor (US)",
-                "Line Frequency",
-                "Vac PWM or Vac+dc PWM",
-                "Rise Time",
-                "Fall Time"]
-
-        nos = {
-                11: "Reading 1",
-                21: "Reading 2",
-                31: "Cursor 1 Amplitude",
-                41: "Cursor 2 Amplitude",
-                53: "Cursor Maximum Amplitude",
-                54: "Cursor Average Amplitude",
-                55: "Cursor Minimum Amplitude",
-                61: "Cursor Relative Amplitude",
-                71: "Cursor Relative Time"}
-
-        sources = {
-                1: "Input A",
-                2: "Input B",
-                3: "Input C",
-                4: "Input D",
-                5: "External Input",
-                12: "Input A vs Input B",
-                21: "Input B vs Input A"}
-
-        class reading_t:
-            no = 0
-            valid = False
-            source = 0
-            unit = 0
-            thetype = 0
-            pres = 0
-            resolution = 0.0
-
-        readings = []
-        separator = ord(',')
-
-        while separator == ord(','):
-            reading = reading_t()
-            reading.no = getDecimal(port, ',')
-            if getDecimal(port, ',') == 1:
-                reading.valid = True
-            reading.source = getDecimal(port, ',')
-            reading.unit = getDecimal(port, ',')
-            reading.thetype = getDecimal(port, ',')
-            reading.pres = getDecimal(port, ',')
-            
-            mantissa = getDecimal(port, 'E')
-            exponent, separator = getDecimal(port)
-            reading.resolution = mantissa * 10.0**exponent
-
-            if reading.valid:
-                readings.append(reading)
+        with phase("transfer QM"):
+            readings = meter.readings()
         print("done")
 
         letter = ord('a')
@@ -852,8 +2665,8 @@ def measurement(port):
         measurement.precision = reading.resolution
 
         print("Fetching reading from ScopeMeter...", end="", flush=True)
-        sendCommand(port, "QM {:d}".format(reading.no))
-        measurement.value = getDecimal(port, 'E') * 10.0**getDecimal(port, '\r')
+        with phase("transfer QM"):
+            measurement.value = meter.reading(reading.no)
         print("done")
 
         print("Result: {}".format(
@@ -862,38 +2675,10 @@ def measurement(port):
             first = copy.deepcopy(measurement)
 
     if measurement_type != 0:
-        if measurement_type < 3:
-            if measurement_type == 1:
-                measurement.value = first.value + measurement.value
-            elif measurement_type == 2:
-                measurement.value = first.value - measurement.value
-            measurement.precision = first.precision + measurement.precision
-            if measurement.unit != first.unit:
-                print("error: units for first and second measurements differ")
-                exit(1)
-        else:
-            value = 0.0
-            if measurement_type == 3:
-                value = first.value * measurement.value
-                if first.unit == measurement.unit:
-                    measurement.unit += '²'
-                else:
-                    measurement.unit = first.unit + measurement.unit
-            elif measurement_type == 4:
-                value = first.value / measurement.value
-                if first.unit == measurement.unit:
-                    measurement.unit = '%'
-                else:
-                    measurement.unit = first.unit + '/' + measurement.unit
-            measurement.precision = value * (
-                    measurement.precision/measurement.value
-                    + first.precision/first.value)
-            measurement.value = value
-            if measurement.unit == '%':
-                measurement.value *= 100
-                measurement.precision *= 100
-
-
+        measurement = combine(first, measurement, measurement_type)
+        if measurement == None:
+            print("error: units for first and second measurements differ")
+            exit(1)
 
         print("Final Result: {}".format(
             si(measurement.value, measurement.precision, measurement.unit)))
@@ -902,7 +2687,7 @@ def measurement(port):
 
     return measurement
 
-def measurements(port):
+def measurements(meter):
     print("\n***** Starting Measurements *****\n")
 
     measurements = []
@@ -910,7 +2695,7 @@ def measurements(port):
     while True:
         print("\n***** Doing Measurement #{:d} *****\n".format(
             len(measurements)+1))
-        x = measurement(port)
+        x = measurement(meter)
         if x == None:
             break
         if len(x.name):
@@ -918,13 +2703,549 @@ def measurements(port):
 
     return measurements
 
-def figure(port):
+class watch_t:
+    no = 0
+    bound = ">"
+    level = 0.0
+    tripped = False
+
+def watchParse(rules):
+    watches = []
+    for rule in rules.split(','):
+        match = re.fullmatch(r'\s*(\d+)\s*([<>])\s*(\S+)\s*', rule)
+        try:
+            if match == None or int(match.group(1)) not in nos:
+                raise ValueError
+            watch = watch_t()
+            watch.no = int(match.group(1))
+            watch.bound = match.group(2)
+            watch.level = float(match.group(3))
+        except ValueError:
+            print("error: bad watch rule “{:s}”".format(rule.strip()))
+            exit(1)
+        watches.append(watch)
+    return watches
+
+def watchInputs(reading):
+    # The waveforms worth having are those of the inputs behind a reading
+    return {1: ["10"], 2: ["20"], 12: ["10", "20"], 21: ["10", "20"]}.get(
+            reading.source,
+            ["10"])
+
+def watchEvent(meter, fired, values, readings, inputs=None, number=0):
+    filterReset(meter.filter)
+    moment = datetime.datetime.now()
+    triggers = []
+    for rule in fired:
+        reading = readings[rule.no]
+        print("{:s} of {:s} at {:s} crossed {:s}{:g}".format(
+            nos[rule.no],
+            sources[reading.source],
+            si(values[rule.no], reading.resolution, units[reading.unit]),
+            rule.bound,
+            rule.level))
+        triggers.append({
+            "reading": rule.no,
+            "name": nos[rule.no],
+            "source": sources[reading.source],
+            "type": types[reading.thetype],
+            "unit": units[reading.unit],
+            "value": values[rule.no],
+            "bound": "{:s}{:g}".format(rule.bound, rule.level)})
+
+    if inputs == None:
+        inputs = []
+        for rule in fired:
+            inputs += [source for source in watchInputs(readings[rule.no])
+                    if source not in inputs]
+    files = []
+    for source in inputs:
+        data = waveform(meter, source)
+        data.channel = chr(ord('A')+int(source[0])-1)
+        classifyTrace(data)
+        # Events can come quicker than the timestamps tick over
+        data.filename = "{:s}_event-{:d}".format(waveformFilename(data), number)
+        writeBehind(data.filename+".npz", 'wb', archiveWrite, data)
+        files.append(data.filename+".npz")
+
+    return {
+            "time": moment.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "triggers": triggers,
+            "waveforms": files,
+            "screenshot": screenshot(meter, "_event-{:d}".format(number))}
+
+def watch(meter, rules, interval=1.0, inputs=None, logName="watch.jsonl"):
+    watches = watchParse(rules)
+
+    print("Downloading measurement metadata from ScopeMeter...", end="", flush=True)
+    with phase("transfer QM"):
+        readings = {reading.no: reading for reading in meter.readings()}
+    print("done")
+    for rule in watches:
+        if rule.no not in readings:
+            print("error: {:s} is not shown on the ScopeMeter".format(nos[rule.no]))
+            exit(1)
+    polled = sorted(set([rule.no for rule in watches]))
+
+    print("Watching {:s} every {:g} s (Ctrl-C to stop)".format(
+        ", ".join([nos[no] for no in polled]),
+        interval))
+    events = 0
+    try:
+        while True:
+            start = time.time()
+            try:
+                values = {}
+                with phase("transfer QM"):
+                    for no in polled:
+                        values[no] = meter.reading(no)
+
+                # Only going past a bound fires; a rule rearms once its
+                # reading is back within it
+                fired = []
+                for rule in watches:
+                    value = values[rule.no]
+                    outside = value > rule.level if rule.bound == '>' else value < rule.level
+                    if outside and not rule.tripped:
+                        fired.append(rule)
+                    rule.tripped = outside
+
+                if len(fired):
+                    record = watchEvent(meter, fired, values, readings, inputs, events)
+                    events += 1
+                    with open(logName, 'a') as logFile:
+                        logFile.write(json.dumps(record)+"\n")
+            except ScopeMeterError as error:
+                # A garbled reply should not end an unattended watch
+                print("error: "+str(error))
+                with open(logName, 'a') as logFile:
+                    logFile.write(json.dumps({
+                        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                        "error": str(error)})+"\n")
+                meter.port.reset_input_buffer()
+            time.sleep(max(0.0, interval-(time.time()-start)))
+    except KeyboardInterrupt:
+        print("\nStopped after {:d} events".format(events))
+        meter.port.reset_input_buffer()
+
+def crossings(x, low, high):
+    # Schmitt trigger with thresholds low/high per row, so noise around a
+    # single level does not count as extra edges
+    state = numpy.zeros(x.shape, numpy.int8)
+    state[x <= low[:, None]] = -1
+    state[x >= high[:, None]] = 1
+    last = numpy.where(state != 0, numpy.arange(x.shape[1]), 0)
+    last = numpy.maximum.accumulate(last, axis=1)
+    state = numpy.take_along_axis(state, last, axis=1)
+    rising = (state[:, :-1] == -1) & (state[:, 1:] == 1)
+    falling = (state[:, :-1] == 1) & (state[:, 1:] == -1)
+
+    return last, rising, falling
+
+def crossing(x, rows, columns, level):
+    # Interpolated position where x passes level between columns and columns+1
+    before = x[rows, columns]
+    after = x[rows, columns+1]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return columns + (level[rows]-before)/(after-before)
+
+def edgeTimes(x, edges, last, low, high):
+    # Duration between passing low and passing high of every edge
+    rows, columns = numpy.nonzero(edges)
+    times = numpy.full(x.shape, numpy.nan)
+    times[rows, columns] = \
+            crossing(x, rows, columns, high) \
+            - crossing(x, rows, last[rows, columns], low)
+    return times
+
+def rowMean(values):
+    valid = numpy.isfinite(values)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(valid, values, 0).sum(axis=1)/valid.sum(axis=1)
+
+def scalars(waveforms, names=None):
+    results = [[] for waveform in waveforms]
+
+    # Bundle the traces of equal length so every statistic is computed for
+    # all of them at once
+    groups = {}
+    for index in range(len(waveforms)):
+        waveform = waveforms[index]
+        # A triggered run's RMS per capture is no sampled waveform
+        if waveform.x_unit != 's' \
+                or waveform.trace_type == 'triggered' \
+                or waveform.samples.shape[0] < 2 \
+                or waveform.samples.shape[1] == 0:
+            continue
+        groups.setdefault(waveform.samples.shape[0], []).append(index)
+
+    for size, indices in groups.items():
+        centre = numpy.empty([len(indices), size])
+        top = numpy.empty([len(indices), size])
+        bottom = numpy.empty([len(indices), size])
+        resolution = numpy.empty(len(indices))
+        delta_x = numpy.empty(len(indices))
+        for row in range(len(indices)):
+            waveform = waveforms[indices[row]]
+            samples = waveform.samples
+            if samples.shape[1] == 3:
+                # The median of min/max/average is the average
+                centre[row] = numpy.median(samples, axis=1)
+            else:
+                centre[row] = samples.mean(axis=1)
+            top[row] = samples.max(axis=1)
+            bottom[row] = samples.min(axis=1)
+            resolution[row] = waveform.y_resolution
+            if resolution[row] == 0:
+                steps = numpy.diff(numpy.unique(
+                    samples[numpy.isfinite(samples)]))
+                resolution[row] = steps.min() if len(steps) else 0
+            delta_x[row] = waveform.delta_x
+
+        # Overloaded traces have no meaningful amplitude
+        clipped = numpy.isinf(top).any(axis=1) | numpy.isinf(bottom).any(axis=1)
+        centre[numpy.isinf(centre)] = numpy.nan
+
+        mean = rowMean(centre)
+        trueRms = numpy.sqrt(rowMean(centre*centre))
+        rms = numpy.sqrt(numpy.maximum(trueRms**2 - mean**2, 0))
+        maximum = numpy.where(numpy.isnan(top), -numpy.inf, top).max(axis=1)
+        minimum = numpy.where(numpy.isnan(bottom), numpy.inf, bottom).min(axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            crest = numpy.maximum(abs(maximum), abs(minimum))/trueRms
+        for value in [mean, trueRms, rms, maximum, minimum, crest]:
+            value[clipped] = numpy.nan
+
+        amplitude = maximum - minimum
+
+        # Timing only needs the levels, which the unclipped part still gives
+        lowest = numpy.where(numpy.isnan(centre), numpy.inf, centre).min(axis=1)
+        swing = numpy.where(numpy.isnan(centre), -numpy.inf, centre).max(axis=1) \
+                - lowest
+        with numpy.errstate(invalid='ignore'):
+            middle = lowest + 0.5*swing
+            last, rising, falling = crossings(
+                    centre,
+                    lowest + 0.4*swing,
+                    lowest + 0.6*swing)
+            columns = numpy.arange(size-1)
+            edges = numpy.where(
+                    rising,
+                    crossing(
+                        centre,
+                        numpy.arange(len(indices))[:, None],
+                        columns[None, :],
+                        middle),
+                    numpy.nan)
+        edges[~numpy.isfinite(edges)] = numpy.nan
+        count = numpy.isfinite(edges).sum(axis=1)
+        first = numpy.where(numpy.isnan(edges), numpy.inf, edges).min(axis=1)
+        final = numpy.where(numpy.isnan(edges), -numpy.inf, edges).max(axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            period = (final-first)/(count-1)*delta_x
+            periodPrecision = delta_x/(count-1)
+
+            # Fraction of whole periods spent above the middle
+            span = (columns[None, :] >= first[:, None]) \
+                    & (columns[None, :] < final[:, None])
+            above = (centre[:, :-1] > middle[:, None]) & span
+            duty = 100.0*above.sum(axis=1)/span.sum(axis=1)
+            dutyPrecision = 100.0*2/span.sum(axis=1)
+
+            last, rising, falling = crossings(
+                    centre,
+                    lowest + 0.1*swing,
+                    lowest + 0.9*swing)
+            rise = rowMean(edgeTimes(
+                centre,
+                rising,
+                last,
+                lowest + 0.1*swing,
+                lowest + 0.9*swing))*delta_x
+            fall = rowMean(edgeTimes(
+                centre,
+                falling,
+                last,
+                lowest + 0.9*swing,
+                lowest + 0.1*swing))*delta_x
+        period[count < 2] = numpy.nan
+        duty[count < 2] = numpy.nan
+
+        for row in range(len(indices)):
+            waveform = waveforms[indices[row]]
+            lsb = resolution[row]
+            values = {
+                    "Mean": (mean, lsb, waveform.y_unit),
+                    "RMS": (rms, lsb, waveform.y_unit),
+                    "True RMS": (trueRms, lsb, waveform.y_unit),
+                    "Peak to Peak": (amplitude, 2*lsb, waveform.y_unit),
+                    "Peak Maximum": (maximum, lsb, waveform.y_unit),
+                    "Peak Minimum": (minimum, lsb, waveform.y_unit),
+                    "Crest Factor": (
+                        crest,
+                        crest[row]*lsb*(
+                            1/max(abs(maximum[row]), abs(minimum[row]))
+                            + 1/trueRms[row]),
+                        ""),
+                    "Period": (period, periodPrecision[row], 's'),
+                    "Duty Cycle Negative": (
+                        100.0-duty,
+                        dutyPrecision[row],
+                        '%'),
+                    "Duty Cycle Positive": (duty, dutyPrecision[row], '%'),
+                    "Frequency": (
+                        1/period,
+                        periodPrecision[row]/period[row]**2,
+                        'Hz'),
+                    "Rise Time": (rise, delta_x[row], 's'),
+                    "Fall Time": (fall, delta_x[row], 's')}
+
+            source = "Input "+waveform.channel
+            if waveform.channel == "both":
+                source = sources[12]
+
+            for thetype in types:
+                if thetype not in values:
+                    continue
+                if names != None and thetype.lower() not in names:
+                    continue
+                value, precision, unit = values[thetype]
+                value = value[row]
+                if not (math.isfinite(value) and math.isfinite(precision)):
+                    continue
+                measurement = measurement_t()
+                measurement.source = source
+                measurement.unit = unit
+                measurement.value = float(value)
+                measurement.precision = float(precision)
+                if len(waveform.title):
+                    measurement.name = waveform.title+" "+thetype
+                else:
+                    measurement.name = source+" "+thetype
+                results[indices[row]].append(measurement)
+
+    return results
+
+class power_t:
+    frequency = 0.0
+    orders = None
+    voltage = None
+    current = None
+    measurements = []
+
+def fillGaps(samples):
+    valid = numpy.isfinite(samples)
+    if valid.all() or not valid.any():
+        return samples
+    positions = numpy.arange(samples.shape[0])
+    return numpy.interp(positions, positions[valid], samples[valid])
+
+def powerQuality(pairs, harmonics=50):
+    results = [None for pair in pairs]
+
+    groups = {}
+    for index in range(len(pairs)):
+        voltage, current = pairs[index]
+        groups.setdefault(
+                (voltage.samples.shape[0], voltage.delta_x),
+                []).append(index)
+
+    for (size, delta_x), indices in groups.items():
+        v = numpy.empty([len(indices), size])
+        c = numpy.empty([len(indices), size])
+        dv = numpy.empty(len(indices))
+        dc = numpy.empty(len(indices))
+        for row in range(len(indices)):
+            voltage, current = pairs[indices[row]]
+            v[row] = fillGaps(voltage.samples[:, 0])
+            c[row] = fillGaps(current.samples[:, 0])
+            dv[row] = voltage.y_resolution
+            dc[row] = current.y_resolution
+        rows = numpy.arange(len(indices))
+
+        # Find the fundamental from the windowed voltage spectrum, refined
+        # by fitting a parabola through the peak
+        spectrum = numpy.log(abs(numpy.fft.rfft(
+            (v-v.mean(axis=1)[:, None])*numpy.hanning(size),
+            axis=1)) + 1e-300)
+        peak = numpy.clip(spectrum[:, 1:-1].argmax(axis=1)+1, 1, spectrum.shape[1]-2)
+        before = spectrum[rows, peak-1]
+        centre = spectrum[rows, peak]
+        after = spectrum[rows, peak+1]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            offset = 0.5*(before-after)/(before-2*centre+after)
+        offset[~numpy.isfinite(offset)] = 0
+        frequency = (peak+offset)/(size*delta_x)
+
+        # The phase drift between the two halves of the record tells how far
+        # off that estimate still is
+        t = numpy.arange(size)*delta_x
+        half = size//2
+        window = numpy.hanning(half)
+        for iteration in range(2):
+            basis = numpy.exp(-2j*math.pi*frequency[:, None]*t[None, :])
+            first = (v[:, :half]*basis[:, :half]*window).sum(axis=1)
+            second = (v[:, half:2*half]*basis[:, half:2*half]*window).sum(axis=1)
+            frequency += numpy.angle(second/first)/(2*math.pi*half*delta_x)
+
+        # Only look at a whole number of cycles so the harmonics fall
+        # exactly on the frequencies we correlate against
+        cycles = numpy.floor(size*delta_x*frequency)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            length = numpy.minimum(
+                    numpy.round(cycles/(frequency*delta_x)),
+                    size)
+        length[cycles < 1] = size
+        weight = numpy.arange(size)[None, :] < length[:, None]
+
+        power = (v*c*weight).sum(axis=1)/length
+        vRms = numpy.sqrt((v*v*weight).sum(axis=1)/length)
+        cRms = numpy.sqrt((c*c*weight).sum(axis=1)/length)
+
+        orders = numpy.arange(1, harmonics+1)
+        vPhasors = numpy.full([len(indices), harmonics], numpy.nan, complex)
+        cPhasors = numpy.full([len(indices), harmonics], numpy.nan, complex)
+        for order in orders:
+            basis = weight*numpy.exp(
+                    -2j*math.pi*order*frequency[:, None]*t[None, :])
+            below = order*frequency < 0.5/delta_x
+            vPhasors[below, order-1] = \
+                    math.sqrt(2)*(v*basis).sum(axis=1)[below]/length[below]
+            cPhasors[below, order-1] = \
+                    math.sqrt(2)*(c*basis).sum(axis=1)[below]/length[below]
+
+        # Phases are given relative to the fundamental of the voltage
+        reference = numpy.exp(-1j*numpy.angle(vPhasors[:, 0]))
+        vPhasors *= reference[:, None]**orders[None, :]
+        cPhasors *= reference[:, None]**orders[None, :]
+
+        vMagnitude = numpy.nan_to_num(abs(vPhasors))
+        cMagnitude = numpy.nan_to_num(abs(cPhasors))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            apparent = vRms*cRms
+            reactive = numpy.sqrt(numpy.maximum(apparent**2 - power**2, 0)) \
+                    * numpy.sign(numpy.sin(-numpy.angle(cPhasors[:, 0])))
+            displacement = numpy.cos(numpy.angle(cPhasors[:, 0]))
+            factor = power/apparent
+            vDistortion = numpy.sqrt((vMagnitude[:, 1:]**2).sum(axis=1))
+            cDistortion = numpy.sqrt((cMagnitude[:, 1:]**2).sum(axis=1))
+            vThdF = 100.0*vDistortion/vMagnitude[:, 0]
+            cThdF = 100.0*cDistortion/cMagnitude[:, 0]
+            vThdR = 100.0*vDistortion/vRms
+            cThdR = 100.0*cDistortion/cRms
+            kUs = (orders**2*cMagnitude**2).sum(axis=1) \
+                    / (cMagnitude**2).sum(axis=1)
+            # EN 50464-3 with the usual e = 0.1 and q = 1.7
+            kEu = numpy.sqrt(1 + 0.1/1.1*(cMagnitude[:, 0]/cRms)**2
+                    * (orders[1:]**1.7*(cMagnitude[:, 1:]
+                        / cMagnitude[:, 0:1])**2).sum(axis=1))
+
+        for row in range(len(indices)):
+            result = power_t()
+            result.frequency = frequency[row]
+            result.orders = orders
+            result.voltage = vPhasors[row]
+            result.current = cPhasors[row]
+
+            powerPrecision = vRms[row]*dc[row] + cRms[row]*dv[row]
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                angle = dv[row]/vMagnitude[row, 0] + dc[row]/cMagnitude[row, 0]
+                relative = powerPrecision/abs(power[row]) \
+                        + powerPrecision/apparent[row]
+            values = [
+                    ("Real Power", sources[12], power, powerPrecision, 'W'),
+                    ("Apparent Power", sources[12], apparent, powerPrecision, 'VA'),
+                    ("Reactive Power", sources[12], reactive, powerPrecision, 'VAR'),
+                    (
+                        "Displacement Power Factor",
+                        sources[12],
+                        displacement,
+                        abs(math.sin(numpy.angle(cPhasors[row, 0])))*angle,
+                        ''),
+                    (
+                        "Total Power Factor",
+                        sources[12],
+                        factor,
+                        abs(factor[row])*relative,
+                        ''),
+                    (
+                        "Total Harmonic Distortion",
+                        sources[1],
+                        vThdR,
+                        100.0*dv[row]/vRms[row],
+                        '%'),
+                    (
+                        "Total Harmonic Distortion with respect to Fundamental",
+                        sources[1],
+                        vThdF,
+                        100.0*dv[row]/vMagnitude[row, 0],
+                        '%'),
+                    (
+                        "Total Harmonic Distortion",
+                        sources[2],
+                        cThdR,
+                        100.0*dc[row]/cRms[row],
+                        '%'),
+                    (
+                        "Total Harmonic Distortion with respect to Fundamental",
+                        sources[2],
+                        cThdF,
+                        100.0*dc[row]/cMagnitude[row, 0],
+                        '%'),
+                    (
+                        "K Factor (US)",
+                        sources[2],
+                        kUs,
+                        2*kUs[row]*dc[row]/cRms[row],
+                        ''),
+                    (
+                        "K Factor (European)",
+                        sources[2],
+                        kEu,
+                        2*kEu[row]*dc[row]/cRms[row],
+                        ''),
+                    (
+                        "Line Frequency",
+                        sources[1],
+                        frequency,
+                        # A sample's worth of time over the whole cycles
+                        frequency[row]**2*delta_x/cycles[row],
+                        'Hz')]
+
+            result.measurements = []
+            for thetype, source, value, precision, unit in values:
+                value = value[row]
+                if not (math.isfinite(value) and math.isfinite(precision)):
+                    continue
+                measurement = measurement_t()
+                measurement.source = source
+                measurement.unit = unit
+                measurement.value = float(value)
+                measurement.precision = float(precision)
+                if source == sources[12]:
+                    measurement.name = thetype
+                else:
+                    measurement.name = source+" "+thetype
+                result.measurements.append(measurement)
+
+            results[indices[row]] = result
+
+    return results
+
+def figure(meter, catalog=None, raw=False, local=None, average=1, trigger=None):
     figure = figure_t()
     figure.title = input("Enter figure title (blank to quit): ")
     if len(figure.title) == 0:
         return None
-    figure.waveforms = waveforms(port)
-    figure.measurements = measurements(port)
+    figure.waveforms = waveforms(meter, raw, average, trigger)
+    figure.measurements = measurements(meter)
+    for data in figure.waveforms:
+        if data.analysis != None:
+            figure.measurements += data.analysis.measurements
+    if local != None:
+        with phase("measurements"):
+            for results in scalars(figure.waveforms, local):
+                figure.measurements += results
     figure.filename = \
             figure.waveforms[0].timestamp.strftime("%Y-%m-%d-%H-%M-%S") \
             + '_' + figure.title.replace(' ', '_').lower()
@@ -965,19 +3286,674 @@ def figure(port):
             values[i]))
     print("└{1:─<{0:d}}┴{3:─<{2:d}}┘".format(nameLength, "", valueLength, ""))
 
+    figureWrite(figure)
+    if catalog != None:
+        catalogAdd(catalog, figure)
+
     return figure
 
-def figures(port):
+def figures(meter, catalog=None, raw=False, local=None, average=1, trigger=None):
     figures = []
     while True:
-        fig = figure(port)
+        fig = figure(meter, catalog, raw, local, average, trigger)
         if fig == None:
             break
         else:
             figures.append(fig)
     return figures
 
+def waveformMeta(waveform):
+    meta = {
+            "channel": waveform.channel,
+            "trace_type": waveform.trace_type,
+            "y_unit": waveform.y_unit,
+            "x_unit": waveform.x_unit,
+            "y_divisions": waveform.y_divisions,
+            "x_divisions": waveform.x_divisions,
+            "y_scale": waveform.y_scale,
+            "x_scale": waveform.x_scale,
+            "x_zero": waveform.x_zero,
+            "y_at_0": waveform.y_at_0,
+            "delta_x": waveform.delta_x,
+            "timestamp": waveform.timestamp.strftime("%Y-%m-%d %H:%M:%S")}
+    if waveform.filtered:
+        meta["filtered"] = waveform.filtered
+    if hasattr(waveform, "window_type"):
+        meta["window_type"] = waveform.window_type
+        meta["window_size"] = waveform.window_size
+    return meta
+
+def figureWrite(fig):
+    waveforms = []
+    for waveform in fig.waveforms:
+        meta = waveformMeta(waveform)
+        meta["title"] = waveform.title
+        meta["filename"] = waveform.filename
+        meta["rows"] = waveform.samples.shape[0]
+        meta["columns"] = waveform.samples.shape[1]
+        meta["averaged"] = waveform.averaged
+        # datWrite only adds the band columns to single column traces
+        meta["uncertainty"] = waveform.uncertainty is not None \
+                and waveform.samples.shape[1] == 1
+        waveforms.append(meta)
+    measurements = []
+    for measurement in fig.measurements:
+        measurements.append({
+                "name": measurement.name,
+                "source": measurement.source,
+                "unit": measurement.unit,
+                "value": measurement.value,
+                "precision": measurement.precision})
+    with open(fig.filename+".json", 'w') as figFile:
+        json.dump({
+                "title": fig.title,
+                "filename": fig.filename,
+                "waveforms": waveforms,
+                "measurements": measurements},
+            figFile,
+            indent=1)
+
+def datRead(filename, columns, uncertainty=False):
+    # One C-level parse of the whole file instead of a loop over lines
+    with open(filename) as datFile:
+        values = numpy.fromstring(datFile.read(), sep=' ')
+    width = 1+columns+(4 if uncertainty else 0)
+    return values.reshape([-1, width])
+
+def figureRead(filename):
+    with open(filename) as figFile:
+        meta = json.load(figFile)
+    if not isinstance(meta, dict) or "waveforms" not in meta:
+        return None
+
+    fig = figure_t()
+    fig.title = meta["title"]
+    fig.filename = meta["filename"]
+    fig.waveforms = []
+    for entry in meta["waveforms"]:
+        data = waveform_t()
+        for key in [
+                "channel", "trace_type", "y_unit", "x_unit",
+                "y_divisions", "x_divisions", "y_scale", "x_scale",
+                "x_zero", "y_at_0", "delta_x", "title", "filename",
+                "averaged", "window_type", "window_size", "filtered"]:
+            if key in entry:
+                setattr(data, key, entry[key])
+        data.timestamp = datetime.datetime.strptime(
+                entry["timestamp"],
+                "%Y-%m-%d %H:%M:%S")
+
+        columns = entry["columns"]
+        if data.trace_type == 'spectrogram':
+            # The plots read the .spg directly
+            data.samples = numpy.empty([entry["rows"], 0])
+        elif os.path.exists(data.filename+".npz") and not data.filtered:
+            # The archive holds the codes as they came, before any filter
+            data.samples = archiveRead(data.filename+".npz").samples
+        else:
+            # Figures saved before the flag followed datWrite may claim
+            # bands on wider traces
+            uncertainty = entry["uncertainty"] and columns == 1
+            values = datRead(data.filename+".dat", columns, uncertainty)
+            data.samples = values[:, 1:1+columns]
+            if uncertainty:
+                data.uncertainty = (values[:, 3:4]-values[:, 2:3])/2
+                data.minimum = values[:, 4:5]
+                data.maximum = values[:, 5:6]
+        fig.waveforms.append(data)
+
+    fig.measurements = []
+    for entry in meta["measurements"]:
+        measurement = measurement_t()
+        measurement.name = entry["name"]
+        measurement.source = entry["source"]
+        measurement.unit = entry["unit"]
+        measurement.value = entry["value"]
+        measurement.precision = entry["precision"]
+        fig.measurements.append(measurement)
+
+    return fig
+
+def figuresRead(directory):
+    figs = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            fig = figureRead(os.path.join(directory, name))
+            if fig != None:
+                figs.append(fig)
+    return figs
+
+def exportKind(directory):
+    # A dataset keeps the format it was started in
+    if os.path.exists(os.path.join(directory, "captures.h5")):
+        return "hdf5"
+    if os.path.exists(os.path.join(directory, "index.jsonl")):
+        return "npz"
+    for root, dirs, files in os.walk(directory):
+        if any([name.endswith(".parquet") for name in files]):
+            return "parquet"
+    if pyarrow != None:
+        return "parquet"
+    if h5py != None:
+        return "hdf5"
+    return "npz"
+
+def exportColumns(waveform):
+    # Every capture gets three value columns (unused ones are NaN) and a
+    # state per value: 0 valid, 1 overload, 2 underload, 3 invalid and
+    # -1 for no such column. Sentinel values become NaN.
+    samples = waveform.samples
+    rows = samples.shape[0]
+    x = waveform.x_zero + waveform.delta_x*numpy.arange(rows)
+    y = numpy.full([rows, 3], numpy.nan)
+    state = numpy.full([rows, 3], -1, numpy.int8)
+    columns = samples.shape[1]
+    state[:, :columns] = 0
+    state[:, :columns][samples == numpy.inf] = 1
+    state[:, :columns][samples == -numpy.inf] = 2
+    state[:, :columns][numpy.isnan(samples)] = 3
+    y[:, :columns] = numpy.where(numpy.isfinite(samples), samples, numpy.nan)
+    return x, y, state
+
+def exportCaptures(directory, waveforms):
+    os.makedirs(directory, exist_ok=True)
+    kind = exportKind(directory)
+    count = 0
+    for waveform in waveforms:
+        if waveform.samples.shape[1] == 0:
+            continue
+        x, y, state = exportColumns(waveform)
+        meta = waveformMeta(waveform)
+        name = waveform.filename or waveformFilename(waveform)
+        rows = x.shape[0]
+
+        if kind == "parquet":
+            # Partitioned by channel, one file per capture, so a timestamp
+            # filter is answered from the file statistics
+            columns = {
+                    "capture": pyarrow.array([name]*rows).dictionary_encode(),
+                    "timestamp": pyarrow.array(numpy.full(
+                        rows,
+                        numpy.datetime64(waveform.timestamp, 's'))),
+                    "trace_type": pyarrow.array([meta["trace_type"]]*rows).dictionary_encode(),
+                    "x_unit": pyarrow.array([meta["x_unit"]]*rows).dictionary_encode(),
+                    "y_unit": pyarrow.array([meta["y_unit"]]*rows).dictionary_encode(),
+                    "x": x}
+            for column in range(3):
+                columns["y{:d}".format(column)] = y[:, column]
+                columns["state{:d}".format(column)] = state[:, column]
+            part = os.path.join(directory, "channel="+meta["channel"])
+            os.makedirs(part, exist_ok=True)
+            table = pyarrow.table(columns).replace_schema_metadata(
+                    {"waveform": json.dumps(meta)})
+            pyarrow.parquet.write_table(
+                    table,
+                    os.path.join(part, name+".parquet"),
+                    row_group_size=65536,
+                    compression="zstd")
+        elif kind == "hdf5":
+            with h5py.File(os.path.join(directory, "captures.h5"), 'a') as store:
+                existed = "captures/"+name in store
+                if existed:
+                    del store["captures/"+name]
+                group = store.create_group("captures/"+name)
+                for key, data in [("x", x), ("y", y), ("state", state)]:
+                    group.create_dataset(
+                            key,
+                            data=data,
+                            chunks=True,
+                            compression="gzip",
+                            shuffle=True)
+                for key, value in meta.items():
+                    if value != None:
+                        group.attrs[key] = value
+                # A small index so queries only open the captures they need
+                for key, value, dtype in [] if existed else [
+                        ("name", name, h5py.string_dtype()),
+                        ("timestamp", numpy.datetime64(waveform.timestamp, 's').astype(numpy.int64), numpy.int64),
+                        ("channel", meta["channel"], h5py.string_dtype())]:
+                    if "index/"+key not in store:
+                        store.create_dataset(
+                                "index/"+key,
+                                shape=(0,),
+                                maxshape=(None,),
+                                chunks=(1024,),
+                                dtype=dtype)
+                    index = store["index/"+key]
+                    index.resize((index.shape[0]+1,))
+                    index[-1] = value
+        else:
+            numpy.savez_compressed(
+                    os.path.join(directory, name+".npz"),
+                    x=x,
+                    y=y,
+                    state=state,
+                    meta=json.dumps(meta))
+            with open(os.path.join(directory, "index.jsonl"), 'a') as indexFile:
+                indexFile.write(json.dumps({
+                    "name": name,
+                    "timestamp": meta["timestamp"],
+                    "channel": meta["channel"]})+"\n")
+        count += 1
+    return count
+
+def exportQuery(directory, since=None, until=None, channel=None):
+    # Returns a dict of equal length numpy columns, ready for a dataframe.
+    # since and until are datetimes; only matching captures are read.
+    kind = exportKind(directory)
+    if kind == "parquet":
+        dataset = pyarrow.dataset.dataset(
+                directory,
+                format="parquet",
+                partitioning="hive")
+        condition = None
+        for test in [
+                since != None and pyarrow.dataset.field("timestamp")
+                    >= pyarrow.scalar(numpy.datetime64(since, 's')),
+                until != None and pyarrow.dataset.field("timestamp")
+                    <= pyarrow.scalar(numpy.datetime64(until, 's')),
+                channel != None and pyarrow.dataset.field("channel") == channel]:
+            if test is not False:
+                condition = test if condition is None else condition & test
+        table = dataset.to_table(filter=condition)
+        if table.num_rows == 0:
+            return {}
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+
+    if kind == "hdf5":
+        filename = os.path.join(directory, "captures.h5")
+        if not os.path.exists(filename):
+            return {}
+        store = h5py.File(filename, 'r')
+        names = store["index/name"].asstr()[:]
+        stamps = store["index/timestamp"][:].astype('datetime64[s]')
+        channels = store["index/channel"].asstr()[:]
+    else:
+        names, stamps, channels = [], [], []
+        filename = os.path.join(directory, "index.jsonl")
+        if os.path.exists(filename):
+            with open(filename) as indexFile:
+                for line in indexFile:
+                    entry = json.loads(line)
+                    names.append(entry["name"])
+                    stamps.append(entry["timestamp"])
+                    channels.append(entry["channel"])
+        # Captures exported again replace their earlier entry
+        latest = {name: number for number, name in enumerate(names)}
+        keep = sorted(latest.values())
+        names = numpy.array(names, dtype=str)[keep]
+        stamps = numpy.array(stamps, dtype='datetime64[s]')[keep]
+        channels = numpy.array(channels, dtype=str)[keep]
+
+    selected = numpy.ones(len(names), dtype=bool)
+    if since != None:
+        selected &= stamps >= numpy.datetime64(since, 's')
+    if until != None:
+        selected &= stamps <= numpy.datetime64(until, 's')
+    if channel != None:
+        selected &= channels == channel
+
+    parts = []
+    for name, stamp, capture_channel in zip(
+            names[selected],
+            stamps[selected],
+            channels[selected]):
+        if kind == "hdf5":
+            group = store["captures/"+name]
+            x, y, state = group["x"][:], group["y"][:], group["state"][:]
+            meta = dict(group.attrs)
+        else:
+            archive = numpy.load(os.path.join(directory, name+".npz"))
+            x, y, state = archive["x"], archive["y"], archive["state"]
+            meta = json.loads(str(archive["meta"]))
+        rows = x.shape[0]
+        part = {
+                "capture": numpy.full(rows, name),
+                "timestamp": numpy.full(rows, stamp),
+                "channel": numpy.full(rows, capture_channel),
+                "trace_type": numpy.full(rows, meta["trace_type"]),
+                "x_unit": numpy.full(rows, meta["x_unit"]),
+                "y_unit": numpy.full(rows, meta["y_unit"]),
+                "x": x}
+        for column in range(3):
+            part["y{:d}".format(column)] = y[:, column]
+            part["state{:d}".format(column)] = state[:, column]
+        parts.append(part)
+    if kind == "hdf5":
+        store.close()
+
+    if len(parts) == 0:
+        return {}
+    return {key: numpy.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+def batchTasks(directory):
+    # Archives taken at the same moment (both channels) are analysed
+    # together. Keys are real paths so a resume matches however the
+    # directory was named.
+    groups = {}
+    for root, dirs, files in os.walk(os.path.realpath(directory)):
+        for name in files:
+            if name.endswith(".npz") and "_input-" in name:
+                key = os.path.join(root, name.split("_input-")[0])
+                groups.setdefault(key, []).append(os.path.join(root, name))
+    return [(key, sorted(groups[key])) for key in sorted(groups)]
+
+batchAmplitudes = ["Mean", "RMS", "True RMS", "Peak to Peak"]
+
+def batchKind(measurement):
+    kinds = [thetype for thetype in types
+            if thetype and measurement.name.endswith(" "+thetype)]
+    return max(kinds, key=len) if len(kinds) else None
+
+def batchAnalyse(filenames):
+    waveforms = [archiveRead(filename) for filename in filenames]
+    rows = []
+
+    # Only two columns can turn out to be a glitch trace or an average
+    for data in waveforms:
+        if data.trace_type in ["trace", "average", "glitch"] \
+                and data.samples.shape[1] == 2:
+            classifyTrace(data)
+
+    results = scalars(waveforms)
+    for data, measurements in zip(waveforms, results):
+        for measurement in measurements:
+            rows.append((
+                data.channel,
+                measurement.name,
+                measurement.value,
+                measurement.precision,
+                measurement.unit))
+
+        if data.x_unit == 's' \
+                and data.samples.shape[1] == 1 \
+                and data.samples.shape[0] >= 8 \
+                and numpy.isfinite(data.samples).any():
+            # Welch needs every sample, so bridge over the invalid ones
+            filled = copy.copy(data)
+            filled.samples = fillGaps(data.samples[:, 0])[:, None]
+            spectrum = psdWaveform(filled)
+            peak = 1+numpy.argmax(spectrum.samples[1:, 0])
+            rows.append((
+                data.channel,
+                "PSD Peak Frequency",
+                spectrum.x_zero+peak*spectrum.delta_x,
+                spectrum.delta_x,
+                "Hz"))
+            rows.append((
+                data.channel,
+                "PSD Peak",
+                float(spectrum.samples[peak, 0]),
+                0.0,
+                spectrum.y_unit))
+
+    voltage = [data for data in waveforms if data.y_unit == 'V']
+    current = [data for data in waveforms if data.y_unit == 'A']
+    if len(voltage) == 1 and len(current) == 1 \
+            and voltage[0].trace_type == current[0].trace_type \
+            and voltage[0].samples.shape == current[0].samples.shape \
+            and voltage[0].samples.shape[1] == 1:
+        product = powerWaveform(copy.deepcopy(voltage[0]), current[0])
+        for measurement in product.analysis.measurements:
+            rows.append((
+                "both",
+                measurement.name,
+                measurement.value,
+                measurement.precision,
+                measurement.unit))
+
+    # The measurement arithmetic of measurement(), first channel against
+    # second, for the amplitudes both of them have: difference and ratio
+    # of like units, and the product of an RMS voltage and current
+    if len(waveforms) == 2:
+        seconds = {}
+        for measurement in results[1]:
+            seconds[batchKind(measurement)] = measurement
+        for first in results[0]:
+            second = seconds.get(batchKind(first))
+            if second == None or batchKind(first) not in batchAmplitudes:
+                continue
+            operations = []
+            if first.unit == second.unit:
+                operations = [(2, "-"), (4, "/")]
+            elif sorted([first.unit, second.unit]) == ['A', 'V'] \
+                    and batchKind(first) in ["RMS", "True RMS"]:
+                operations = [(3, "*")]
+            for measurement_type, symbol in operations:
+                try:
+                    result = combine(first, second, measurement_type)
+                except ZeroDivisionError:
+                    continue
+                if result == None:
+                    continue
+                rows.append((
+                    "both",
+                    "{:s} {:s} {:s}".format(first.name, symbol, second.name),
+                    result.value,
+                    result.precision,
+                    result.unit))
+
+    return [data.trace_type for data in waveforms], rows
+
+def batch(directory, outputName, jobs=None):
+    output = sqlite3.connect(outputName)
+    output.execute("PRAGMA journal_mode=WAL")
+    output.executescript(textwrap.dedent('''\
+            CREATE TABLE IF NOT EXISTS batch_captures (
+                capture TEXT PRIMARY KEY,
+                files INTEGER,
+                trace_types TEXT,
+                error TEXT);
+            CREATE TABLE IF NOT EXISTS batch_results (
+                capture TEXT NOT NULL,
+                channel TEXT,
+                name TEXT,
+                value REAL,
+                precision REAL,
+                unit TEXT);
+            CREATE INDEX IF NOT EXISTS batch_results_capture
+                ON batch_results (capture);
+            '''))
+
+    # Whatever finished before an interruption is not done again; what
+    # failed is tried again
+    done = set([row[0] for row in output.execute(
+        "SELECT capture FROM batch_captures WHERE error IS NULL")])
+    tasks = [task for task in batchTasks(directory) if task[0] not in done]
+    print("Analysing {:d} captures ({:d} done before) on {:d} processes...".format(
+        len(tasks),
+        len(done),
+        jobs or os.cpu_count()))
+
+    count = 0
+    pool = concurrent.futures.ProcessPoolExecutor(jobs)
+    futures = {}
+    for key, filenames in tasks:
+        futures[pool.submit(batchAnalyse, filenames)] = (key, filenames)
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            key, filenames = futures[future]
+            try:
+                traceTypes, rows = future.result()
+                error = None
+            except Exception as exception:
+                traceTypes, rows = [], []
+                error = str(exception) or type(exception).__name__
+            with output:
+                output.execute(
+                        "DELETE FROM batch_results WHERE capture = ?",
+                        (key,))
+                output.executemany(
+                        "INSERT INTO batch_results VALUES (?, ?, ?, ?, ?, ?)",
+                        [(key,)+row for row in rows])
+                output.execute(
+                        "INSERT OR REPLACE INTO batch_captures VALUES (?, ?, ?, ?)",
+                        (key, len(filenames), ",".join(traceTypes), error))
+            count += 1
+            if error != None:
+                print("error: {:s}: {:s}".format(key, error))
+            elif count % 100 == 0:
+                print("Analysed {:d} of {:d}".format(count, len(tasks)))
+    except KeyboardInterrupt:
+        print("\nStopped after {:d} captures, run again to resume".format(count))
+        pool.shutdown(wait=False, cancel_futures=True)
+        output.close()
+        return count
+    pool.shutdown()
+    output.close()
+    print("Analysed {:d} captures into {:s}".format(count, outputName))
+    return count
+
+def catalogOpen(filename):
+    catalog = sqlite3.connect(filename)
+    catalog.execute("PRAGMA journal_mode=WAL")
+    catalog.executescript(textwrap.dedent('''\
+            CREATE TABLE IF NOT EXISTS captures (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                channel TEXT,
+                trace_type TEXT,
+                x_unit TEXT,
+                y_unit TEXT,
+                x_scale REAL,
+                y_scale REAL,
+                x_divisions INTEGER,
+                y_divisions INTEGER,
+                x_zero REAL,
+                delta_x REAL,
+                samples INTEGER,
+                filename TEXT NOT NULL UNIQUE,
+                title TEXT,
+                figure TEXT);
+            CREATE INDEX IF NOT EXISTS captures_timestamp
+                ON captures (timestamp);
+            CREATE INDEX IF NOT EXISTS captures_selection
+                ON captures (channel, trace_type, y_unit, timestamp);
+            '''))
+    return catalog
+
+def catalogAdd(catalog, fig):
+    rows = []
+    for waveform in fig.waveforms:
+        rows.append((
+            waveform.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            waveform.channel,
+            waveform.trace_type,
+            waveform.x_unit,
+            waveform.y_unit,
+            waveform.x_scale,
+            waveform.y_scale,
+            waveform.x_divisions,
+            waveform.y_divisions,
+            waveform.x_zero,
+            waveform.delta_x,
+            waveform.samples.shape[0],
+            os.path.abspath(dataFilename(waveform)),
+            waveform.title,
+            fig.title))
+    with catalog:
+        catalog.executemany(
+                "INSERT OR REPLACE INTO captures ("
+                "timestamp, channel, trace_type, x_unit, y_unit, "
+                "x_scale, y_scale, x_divisions, y_divisions, "
+                "x_zero, delta_x, samples, filename, title, figure) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+def catalogScan(catalog, directory):
+    # Captures written before the catalog existed only have their filename.
+    # Suffixed files such as _harmonics.dat are not captures.
+    pattern = re.compile(
+            r"^(\d{4})-(\d\d)-(\d\d)-(\d\d)-(\d\d)-(\d\d)"
+            r"_input-([^_]+)_([^_]+)_(.+)-vs-([^_]+)\.dat$")
+    rows = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            match = pattern.match(name)
+            if match == None:
+                continue
+            filename = os.path.abspath(os.path.join(root, name))
+            with open(filename, 'rb') as datFile:
+                samples = datFile.read().count(b"\n")
+            rows.append((
+                "{}-{}-{} {}:{}:{}".format(*match.groups()[0:6]),
+                match.group(7),
+                match.group(8).replace('-', ' '),
+                match.group(9),
+                match.group(10).replace('per', '/'),
+                samples,
+                filename))
+    with catalog:
+        catalog.executemany(
+                "INSERT OR IGNORE INTO captures ("
+                "timestamp, channel, trace_type, x_unit, y_unit, "
+                "samples, filename) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+    return len(rows)
+
+def catalogTime(string, end=False):
+    for form in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            moment = datetime.datetime.strptime(string, form)
+        except ValueError:
+            continue
+        if end and form == "%Y-%m-%d":
+            moment += datetime.timedelta(days=1, seconds=-1)
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+    print("error: unable to decode time “{:s}”".format(string))
+    exit(1)
+
+def catalogQuery(
+        catalog,
+        channel=None,
+        trace_type=None,
+        unit=None,
+        since=None,
+        until=None):
+    conditions = []
+    parameters = []
+    for column, value in [
+            ("channel", channel),
+            ("trace_type", trace_type),
+            ("y_unit", unit)]:
+        if value != None:
+            conditions.append(column+" = ?")
+            parameters.append(value)
+    if since != None:
+        conditions.append("timestamp >= ?")
+        parameters.append(catalogTime(since))
+    if until != None:
+        conditions.append("timestamp <= ?")
+        parameters.append(catalogTime(until, True))
+
+    query = "SELECT timestamp, channel, trace_type, x_unit, y_unit, " \
+            "samples, filename, title, figure FROM captures"
+    if len(conditions):
+        query += " WHERE "+" AND ".join(conditions)
+    query += " ORDER BY timestamp"
+
+    return catalog.execute(query, parameters).fetchall()
+
+def catalogPrint(rows):
+    for row in rows:
+        print("{:s}  {:>4s}  {:<14s} {:>4s} vs {:<8s} {:>6d}  {:s}".format(
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            row[4],
+            row[5] if row[5] != None else 0,
+            row[6]))
+        if row[8] != None:
+            print("{:>22s}“{:s}” in figure “{:s}”".format(
+                "",
+                row[7] if row[7] != None else "",
+                row[8]))
+    print("{:d} captures".format(len(rows)))
+
 def tex(figs):
+    writerDrain()
     try:
         os.mkdir("tex")
     except OSError:
@@ -1008,7 +3984,7 @@ def tex(figs):
     for fig in figs:
         datFiles = []
         for waveform in fig.waveforms:
-            datFiles.append("../"+waveform.filename+'.dat')
+            datFiles.append("../"+dataFilename(waveform))
         makefile.write(textwrap.dedent('''\
         {0:s}.tex: {0:s}.gpi {1:s}
         \tgnuplot {0:s}.gpi
@@ -1021,7 +3997,17 @@ def tex(figs):
                 set term tikz size 4.75in,3.3in
                 set output '{:s}.tex'
         '''.format(fig.filename)))
-        if(fig.waveforms[0].x_unit == 'Hz'):
+        if fig.waveforms[0].trace_type == 'spectrogram':
+            plotFile.write(textwrap.dedent('''\
+                    set xlabel "Time (s)"
+                    set ylabel "Frequency (Hz)"
+                    set cblabel "Spectral Density (${:s}$)"
+                    unset key
+                    plot '../{:s}.spg' binary matrix with image
+                    '''.format(
+                        texify(fig.waveforms[0].y_unit).replace("\\", "\\\\"),
+                        fig.waveforms[0].filename)))
+        elif(fig.waveforms[0].x_unit == 'Hz'):
             x_min = 10.0**(math.log10(
                             fig.waveforms[0].x_zero
                             +fig.waveforms[0].delta_x
@@ -1086,7 +4072,12 @@ def tex(figs):
                         '''.format(
                             fig.waveforms[0].title,
                             y_scale[0].replace("\\", "\\\\"))))
-                if fig.waveforms[0].samples.shape[1]==1:
+                if fig.waveforms[0].samples.shape[1]==1 \
+                        and fig.waveforms[0].uncertainty is not None:
+                    plotFile.write(textwrap.dedent('''\
+                            plot '../{0:s}.dat' using 1:3:4 with filledcurves fc rgb 'gray', '../{0:s}.dat' using 1:2 with lines lt 1 lc rgb 'black'
+                            '''.format(fig.waveforms[0].filename)))
+                elif fig.waveforms[0].samples.shape[1]==1:
                     plotFile.write(textwrap.dedent('''\
                             plot '../{:s}.dat' using 1:2 with lines lt 1 lc rgb 'black'
                             '''.format(fig.waveforms[0].filename)))
@@ -1103,6 +4094,12 @@ def tex(figs):
                 wavs = []
                 colors = ['red', 'blue']
                 for i in range(2):
+                    if fig.waveforms[i].samples.shape[1]==1 \
+                            and fig.waveforms[i].uncertainty is not None:
+                        wavs.append("'../{0:s}.dat' using ($1):($3*{1:e}):($4*{1:e}) with filledcurves fc rgb '{2:s}' fs transparent solid 0.3 notitle".format(
+                            fig.waveforms[i].filename,
+                            scalers[i],
+                            colors[i]))
                     if fig.waveforms[i].samples.shape[1]==1:
                         wavs.append("'../{:s}.dat' using ($1):($2*{:e}) with lines lt 1 lc rgb '{:s}' title '{:s} (${:s}$)'".format(
                             fig.waveforms[i].filename,
@@ -1133,7 +4130,8 @@ def tex(figs):
         texFile.write(r"            Aquisition Time & "
                 + fig.waveforms[0].timestamp.strftime("%B %d, %Y at %H:%M:%S")
                 + " \\\\\n")
-        if fig.waveforms[0].x_unit == 'Hz':
+        if fig.waveforms[0].x_unit == 'Hz' \
+                or fig.waveforms[0].trace_type == 'spectrogram':
             texFile.write(
                     r"            Window Type & "
                     + fig.waveforms[0].window_type
@@ -1173,7 +4171,204 @@ def tex(figs):
     texFile.close()
     os.chdir("..")
 
-def html(figs):
+plotScript = """\
+function plotDraw(canvas, series, view) {
+    var context = canvas.getContext("2d");
+    var width = canvas.width, height = canvas.height;
+    context.clearRect(0, 0, width, height);
+    context.strokeStyle = "#ddd";
+    context.beginPath();
+    for (var i = 0; i <= 10; i++) {
+        context.moveTo(i*width/10, 0);
+        context.lineTo(i*width/10, height);
+    }
+    for (var i = 0; i <= 8; i++) {
+        context.moveTo(0, i*height/8);
+        context.lineTo(width, i*height/8);
+    }
+    context.stroke();
+
+    series.forEach(function(s) {
+        var rows = s.y.length/s.columns;
+        var row = function(x) { return (x-s.x_zero)/s.delta_x; };
+        var pixel = function(y) { return height*(s.y_max-y)/(s.y_max-s.y_min); };
+        var first = Math.max(0, Math.floor(row(view.start)));
+        var last = Math.min(rows, Math.ceil(row(view.end))+1);
+        context.strokeStyle = s.color;
+        context.beginPath();
+        if (last-first > 2*width) {
+            // More samples than pixels: draw the min/max of each column
+            for (var x = 0; x < width; x++) {
+                var from = Math.max(first, Math.floor(row(view.start+(view.end-view.start)*x/width)));
+                var to = Math.min(last, Math.floor(row(view.start+(view.end-view.start)*(x+1)/width))+1);
+                var low = Infinity, high = -Infinity;
+                for (var i = from*s.columns; i < to*s.columns; i++) {
+                    if (s.y[i] < low) low = s.y[i];
+                    if (s.y[i] > high) high = s.y[i];
+                }
+                if (low > high)
+                    continue;
+                context.moveTo(x+0.5, pixel(high));
+                context.lineTo(x+0.5, pixel(low)+1);
+            }
+        } else {
+            for (var column = 0; column < s.columns; column++) {
+                var drawing = false;
+                for (var i = first; i < last; i++) {
+                    var y = s.y[i*s.columns+column];
+                    var x = width*(s.x_zero+i*s.delta_x-view.start)/(view.end-view.start);
+                    if (isNaN(y)) {
+                        drawing = false;
+                    } else if (drawing) {
+                        context.lineTo(x, pixel(y));
+                    } else {
+                        context.moveTo(x, pixel(y));
+                        drawing = true;
+                    }
+                }
+            }
+        }
+        context.stroke();
+    });
+}
+
+function plotInit(canvas, series) {
+    var s = series[0];
+    var full = {start: s.x_zero, end: s.x_zero+s.delta_x*s.y.length/s.columns};
+    var view = {start: full.start, end: full.end};
+    var dragging = null;
+    canvas.addEventListener("wheel", function(event) {
+        event.preventDefault();
+        var at = view.start+(view.end-view.start)*event.offsetX/canvas.width;
+        var factor = event.deltaY > 0 ? 1.25 : 0.8;
+        view.start = at-(at-view.start)*factor;
+        view.end = at+(view.end-at)*factor;
+        plotDraw(canvas, series, view);
+    });
+    canvas.addEventListener("mousedown", function(event) {
+        dragging = {x: event.offsetX, start: view.start, end: view.end};
+    });
+    canvas.addEventListener("mousemove", function(event) {
+        if (dragging == null)
+            return;
+        var shift = (dragging.x-event.offsetX)*(dragging.end-dragging.start)/canvas.width;
+        view.start = dragging.start+shift;
+        view.end = dragging.end+shift;
+        plotDraw(canvas, series, view);
+    });
+    window.addEventListener("mouseup", function() { dragging = null; });
+    canvas.addEventListener("dblclick", function() {
+        view.start = full.start;
+        view.end = full.end;
+        plotDraw(canvas, series, view);
+    });
+    plotDraw(canvas, series, view);
+}
+
+function plotLoad(canvas) {
+    var series = JSON.parse(canvas.dataset.series);
+    Promise.all(series.map(function(s) {
+        return fetch(s.blob).then(function(response) {
+            return response.arrayBuffer();
+        }).then(function(buffer) {
+            if (s.type == "int16") {
+                var codes = new Int16Array(buffer);
+                s.y = new Float32Array(codes.length);
+                for (var i = 0; i < codes.length; i++) {
+                    var code = codes[i];
+                    if (code == s.overload || code == s.underload || code == s.invalid)
+                        s.y[i] = NaN;
+                    else
+                        s.y[i] = s.y_zero+code*s.y_resolution;
+                }
+            } else {
+                s.y = new Float32Array(buffer).map(function(y) {
+                    return isFinite(y) ? y : NaN;
+                });
+            }
+        });
+    })).then(function() { plotInit(canvas, series); });
+}
+
+// Only fetch the samples of plots that scroll into view
+var plotObserver = new IntersectionObserver(function(entries) {
+    entries.forEach(function(entry) {
+        if (entry.isIntersecting) {
+            plotObserver.unobserve(entry.target);
+            plotLoad(entry.target);
+        }
+    });
+});
+document.addEventListener("DOMContentLoaded", function() {
+    document.querySelectorAll("canvas.plot").forEach(function(canvas) {
+        plotObserver.observe(canvas);
+    });
+});
+"""
+
+def blobWrite(waveform, color):
+    series = {
+            "blob": waveform.filename+".bin",
+            "columns": waveform.samples.shape[1],
+            "x_zero": waveform.x_zero,
+            "delta_x": waveform.delta_x,
+            "y_min": waveform.y_at_0,
+            "y_max": waveform.y_at_0+waveform.y_divisions*waveform.y_scale,
+            "color": color}
+
+    # Raw codes are half the size of floats, but only if they still
+    # describe the samples (they don't for averaged or derived traces)
+    codes = waveform.codes
+    if codes is not None \
+            and codes.shape == waveform.samples.shape \
+            and codes.dtype.itemsize <= 2 \
+            and codes.min(initial=0) >= -32768 \
+            and codes.max(initial=0) <= 32767 \
+            and numpy.array_equal(
+                decodeSamples(waveform),
+                waveform.samples,
+                equal_nan=True):
+        codes.astype('<i2').tofile(series["blob"])
+        series["type"] = "int16"
+        series["y_zero"] = waveform.y_zero
+        series["y_resolution"] = waveform.y_resolution
+        series["overload"] = int(waveform.overload)
+        series["underload"] = int(waveform.underload)
+        series["invalid"] = int(waveform.invalid)
+    else:
+        waveform.samples.astype('<f4').tofile(series["blob"])
+        series["type"] = "float32"
+
+    return series
+
+def htmlOpen(filename, title, interactive=False):
+    htmlFile = open(filename, 'w')
+    htmlFile.write(textwrap.dedent('''\
+            <!DOCTYPE html>
+            <html lang="en-ca">\
+            <head>\
+            <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+		    <meta charset="utf-8" />\
+            <title>{:s}</title>\
+            '''.format(title)))
+    if interactive:
+        htmlFile.write('<script src="plot.js"></script>')
+    htmlFile.write("</head><body>\n")
+    return htmlFile
+
+def htmlNavigation(htmlFile, page, pages):
+    links = ['<a href="report.html">Index</a>']
+    if page > 1:
+        links.append('<a href="page-{:d}.html">Previous</a>'.format(page-1))
+    if page < pages:
+        links.append('<a href="page-{:d}.html">Next</a>'.format(page+1))
+    htmlFile.write("<nav>{:s} (page {:d} of {:d})</nav>\n".format(
+        " | ".join(links),
+        page,
+        pages))
+
+def html(figs, pageSize=25, interactive=False):
+    writerDrain()
     try:
         os.mkdir("html")
     except OSError:
@@ -1183,22 +4378,31 @@ def html(figs):
     makefile = open("Makefile", 'w')
     figFiles = []
 
-    htmlFile = open("report.html", 'w')
-    htmlFile.write(textwrap.dedent('''\
-            <!DOCTYPE html>
-            <html lang="en-ca">\
-            <head>\
-            <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
-		    <meta charset="utf-8" />\
-            </head><body>
-            '''))
+    # report.html is only an index; the figures themselves go on pages
+    pages = max(1, math.ceil(len(figs)/pageSize))
+    indexFile = htmlOpen("report.html", "Report")
+    indexFile.write("<table>\n")
+    manifest = []
+    htmlFile = None
 
     figNum = 1
 
     for fig in figs:
+        page = (figNum-1)//pageSize + 1
+        if (figNum-1) % pageSize == 0:
+            if htmlFile != None:
+                htmlNavigation(htmlFile, page-1, pages)
+                htmlFile.write("</body></html>")
+                htmlFile.close()
+            htmlFile = htmlOpen(
+                    "page-{:d}.html".format(page),
+                    "Report (page {:d})".format(page),
+                    interactive)
+            htmlNavigation(htmlFile, page, pages)
+
         datFiles = []
         for waveform in fig.waveforms:
-            datFiles.append("../"+waveform.filename+'.dat')
+            datFiles.append("../"+dataFilename(waveform))
         makefile.write(textwrap.dedent('''\
         {0:s}.svg: {0:s}.gpi {1:s}
         \tgnuplot {0:s}.gpi
@@ -1212,7 +4416,17 @@ def html(figs):
                 set output '{:s}.svg'
                 set encoding utf8
         '''.format(fig.filename)))
-        if(fig.waveforms[0].x_unit == 'Hz'):
+        if fig.waveforms[0].trace_type == 'spectrogram':
+            plotFile.write(textwrap.dedent('''\
+                    set xlabel "Time (s)"
+                    set ylabel "Frequency (Hz)"
+                    set cblabel "Spectral Density ({:s})"
+                    unset key
+                    plot '../{:s}.spg' binary matrix with image
+                    '''.format(
+                        fig.waveforms[0].y_unit,
+                        fig.waveforms[0].filename)))
+        elif(fig.waveforms[0].x_unit == 'Hz'):
             x_min = 10.0**(math.log10(
                             fig.waveforms[0].x_zero
                             +fig.waveforms[0].delta_x
@@ -1277,7 +4491,12 @@ def html(figs):
                         '''.format(
                             fig.waveforms[0].title,
                             y_scale[0])))
-                if fig.waveforms[0].samples.shape[1]==1:
+                if fig.waveforms[0].samples.shape[1]==1 \
+                        and fig.waveforms[0].uncertainty is not None:
+                    plotFile.write(textwrap.dedent('''\
+                            plot '../{0:s}.dat' using 1:3:4 with filledcurves fc rgb 'gray', '../{0:s}.dat' using 1:2 with lines lt 1 lc rgb 'black'
+                            '''.format(fig.waveforms[0].filename)))
+                elif fig.waveforms[0].samples.shape[1]==1:
                     plotFile.write(textwrap.dedent('''\
                             plot '../{:s}.dat' using 1:2 with lines lt 1 lc rgb 'black'
                             '''.format(fig.waveforms[0].filename)))
@@ -1294,6 +4513,12 @@ def html(figs):
                 wavs = []
                 colors = ['red', 'blue']
                 for i in range(2):
+                    if fig.waveforms[i].samples.shape[1]==1 \
+                            and fig.waveforms[i].uncertainty is not None:
+                        wavs.append("'../{0:s}.dat' using ($1):($3*{1:e}):($4*{1:e}) with filledcurves fc rgb '{2:s}' fs transparent solid 0.3 notitle".format(
+                            fig.waveforms[i].filename,
+                            scalers[i],
+                            colors[i]))
                     if fig.waveforms[i].samples.shape[1]==1:
                         wavs.append("'../{:s}.dat' using ($1):($2*{:e}) with lines lt 1 lc rgb '{:s}' title '{:s} ({:s})'".format(
                             fig.waveforms[i].filename,
@@ -1315,12 +4540,50 @@ def html(figs):
                         '''.format(", ".join(wavs))))
 
         plotFile.close()
-        htmlFile.write(textwrap.dedent('''\
-            <figure id="fig{:d}">\
-            <img src="{:s}.svg" height="456" width="608" />\
-            <table>'''.format(
+        indexFile.write(textwrap.dedent('''\
+            <tr>\
+            <td><a href="page-{0:d}.html#fig{1:d}">Figure {1:d}</a></td>\
+            <td>{2:s}</td>\
+            <td>{3:s}</td>\
+            </tr>
+            '''.format(
+                page,
                 figNum,
-                fig.filename)))
+                escape(fig.title),
+                fig.waveforms[0].timestamp.strftime("%Y-%m-%d %H:%M:%S"))))
+        manifest.append({
+            "number": figNum,
+            "title": fig.title,
+            "page": "page-{:d}.html".format(page),
+            "image": fig.filename+".svg",
+            "timestamp": fig.waveforms[0].timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            "measurements": [{
+                    "name": measurement.name,
+                    "value": measurement.value
+                        if math.isfinite(measurement.value) else None,
+                    "unit": measurement.unit}
+                for measurement in fig.measurements]})
+
+        if interactive \
+                and fig.waveforms[0].x_unit == 's' \
+                and fig.waveforms[0].trace_type != 'spectrogram':
+            series = []
+            colors = ['black'] if len(fig.waveforms) == 1 else ['red', 'blue']
+            for waveform, color in zip(fig.waveforms, colors):
+                series.append(blobWrite(waveform, color))
+            htmlFile.write(textwrap.dedent('''\
+                <figure id="fig{:d}">\
+                <canvas class="plot" height="456" width="608" data-series="{:s}"></canvas>\
+                <table>'''.format(
+                    figNum,
+                    escape(json.dumps(series)))))
+        else:
+            htmlFile.write(textwrap.dedent('''\
+                <figure id="fig{:d}">\
+                <img src="{:s}.svg" height="456" width="608" loading="lazy" decoding="async" />\
+                <table>'''.format(
+                    figNum,
+                    fig.filename)))
         htmlFile.write(textwrap.dedent('''\
                 <tr>\
                 <td style="text-align: right">Aquisition Time</td>\
@@ -1329,7 +4592,8 @@ def html(figs):
                 '''.format(
                     fig.waveforms[0].timestamp.strftime("%B %d, %Y at %H:%M:%S")
                     )))
-        if fig.waveforms[0].x_unit == 'Hz':
+        if fig.waveforms[0].x_unit == 'Hz' \
+                or fig.waveforms[0].trace_type == 'spectrogram':
             htmlFile.write(textwrap.dedent('''\
                     <tr>\
                     <td style="text-align: right">Window Type</td>\
@@ -1350,7 +4614,7 @@ def html(figs):
                     <td style="text-align: left">{:s}</td>\
                     </tr>\
                     '''.format(
-                        measurement.name,
+                        escape(measurement.name),
                         si(
                             measurement.value,
                             measurement.precision,
@@ -1360,7 +4624,7 @@ def html(figs):
             </table>\
             <figcaption>Figure {:d}: {:s}</figcaption>\
             </figure>
-            '''.format(figNum, fig.title)))
+            '''.format(figNum, escape(fig.title))))
 
         figNum += 1
 
@@ -1372,27 +4636,567 @@ def html(figs):
     '''.format(" ".join(figFiles))))
     makefile.close()
 
+    if htmlFile == None:
+        htmlFile = htmlOpen("page-1.html", "Report (page 1)", interactive)
+    htmlNavigation(htmlFile, pages, pages)
     htmlFile.write("</body></html>")
     htmlFile.close()
+
+    indexFile.write("</table>\n")
+    for page in range(1, pages+1):
+        indexFile.write('<a href="page-{0:d}.html">Page {0:d}</a>\n'.format(page))
+    indexFile.write("</body></html>")
+    indexFile.close()
+
+    with open("manifest.json", 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1)
+
+    if interactive:
+        with open("plot.js", 'w') as scriptFile:
+            scriptFile.write(plotScript)
+
     os.chdir("..")
 
-def execute(arguments, port):
+def datColumns(waveform):
+    # The columns of the .dat file, as binary
+    x = waveform.x_zero + waveform.delta_x*numpy.arange(waveform.samples.shape[0])
+    columns = [x[:, None], waveform.samples]
+    if waveform.uncertainty is not None and waveform.samples.shape[1] == 1:
+        columns += [
+                waveform.samples-waveform.uncertainty,
+                waveform.samples+waveform.uncertainty,
+                waveform.minimum,
+                waveform.maximum]
+    return numpy.ascontiguousarray(numpy.hstack(columns), numpy.float64)
+
+class renderer_t:
+    process = None
+    count = 0
+
+def rendererOpen(directory):
+    # Errors come back on the same pipe as the end-of-figure markers
+    renderer = renderer_t()
+    try:
+        renderer.process = subprocess.Popen(
+                ["gnuplot"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=directory)
+    except OSError as error:
+        return None, str(error)
+    renderer.process.stdin.write(b"set print '-'\n")
+    return renderer, None
+
+def rendererClose(renderer, kill=False):
+    try:
+        if kill:
+            renderer.process.kill()
+        else:
+            renderer.process.stdin.close()
+    except OSError:
+        pass
+    renderer.process.wait()
+
+def renderFigure(renderer, directory, fig):
+    with open(os.path.join(directory, fig.filename+".gpi")) as plotFile:
+        script = plotFile.read()
+
+    # Each '../name.dat' the script plots becomes inline binary data that
+    # follows the plot command down the pipe
+    waveforms = dict([(waveform.filename, waveform) for waveform in fig.waveforms])
+    payload = bytearray()
+    for line in script.splitlines(True):
+        blobs = []
+        def inline(match):
+            data = datColumns(waveforms[match.group(1)])
+            blobs.append(data.tobytes())
+            return "'-' binary record={:d} format='{:s}' using".format(
+                    data.shape[0],
+                    "%float64"*data.shape[1])
+        payload += re.sub(r"'\.\./([^']+)\.dat' using", inline, line).encode()
+        for blob in blobs:
+            payload += blob
+
+    # gnuplot reading commands from a pipe carries on after an error, so
+    # the figure only counts as rendered if nothing but its own marker
+    # comes back
+    renderer.count += 1
+    marker = "rendered {:d}".format(renderer.count).encode()
+    payload += b"\nunset output\nreset\nset print '-'\nprint '"+marker+b"'\n"
+
+    try:
+        renderer.process.stdin.write(payload)
+        renderer.process.stdin.flush()
+    except OSError as error:
+        return str(error)
+    messages = []
+    while True:
+        line = renderer.process.stdout.readline()
+        if len(line) == 0:
+            messages.append("gnuplot quit")
+            break
+        if line.strip() == marker:
+            break
+        if len(line.strip()):
+            messages.append(line.decode(errors='replace').strip())
+    # What follows the first complaint is mostly the data read as commands
+    return "; ".join(messages[:2]) if len(messages) else None
+
+def renderWorker(directory, renderer, tasks, failures):
+    while renderer != None:
+        try:
+            fig = tasks.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            error = renderFigure(renderer, directory, fig)
+        except Exception as exception:
+            # Nothing may end the thread with its figures still queued
+            error = "{:s}: {:s}".format(type(exception).__name__, str(exception))
+        if error != None:
+            # Whatever state it is left in, the next figure gets a fresh one
+            failures.append((fig.filename, error))
+            rendererClose(renderer, True)
+            renderer, error = rendererOpen(directory)
+            if renderer == None:
+                failures.append(("gnuplot", error))
+    if renderer != None:
+        rendererClose(renderer)
+
+def render(directory, figs, jobs=None):
+    # A few long-lived gnuplot processes take the figures in turn, so
+    # there is no start-up per figure and no .dat for them to parse.
+    # Returns how many figures did not render.
+    writerDrain()
+    tasks = queue.Queue()
+    for fig in figs:
+        tasks.put(fig)
+    failures = []
+    workers = []
+    for number in range(max(1, min(jobs or os.cpu_count() or 1, len(figs)))):
+        renderer, error = rendererOpen(directory)
+        if renderer == None:
+            print("error: cannot start gnuplot: "+error)
+            exit(1)
+        workers.append(threading.Thread(
+            target=renderWorker,
+            args=(directory, renderer, tasks, failures)))
+
+    print("Rendering {:d} figures with {:d} gnuplot processes...".format(
+        len(figs),
+        len(workers)), end="", flush=True)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print("done")
+    for filename, error in failures:
+        print("error: gnuplot failed to render {:s}: {:s}".format(filename, error))
+    if tasks.qsize():
+        print("error: {:d} figures were not rendered".format(tasks.qsize()))
+    return len([failure for failure in failures if failure[0] != "gnuplot"]) \
+            + tasks.qsize()
+
+def waveformJson(waveform):
+    meta = waveformMeta(waveform)
+    # Overload, underload and invalid come out as Infinity, -Infinity and NaN
+    meta["samples"] = waveform.samples.tolist()
+    return meta
+
+class job_t:
+    done = None
+    result = None
+    error = None
+
+class Acquisition:
+    uncached = ["datetime"]
+
+    def __init__(self, meter, ttl=1.0):
+        self.meter = meter
+        self.ttl = ttl
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def serve(self):
+        # The only thread that ever touches the serial port
+        while True:
+            request, job = self.queue.get()
+            try:
+                job.result = self.perform(request)
+            except Exception as error:
+                # Whatever went wrong, the waiting clients get an answer and
+                # this thread lives on to serve the next request
+                job.error = str(error) or type(error).__name__
+                try:
+                    self.meter.port.reset_input_buffer()
+                except Exception:
+                    pass
+            finally:
+                with self.lock:
+                    del self.pending[request]
+                    if job.error == None and request[0] not in self.uncached:
+                        self.cache[request] = (time.monotonic(), job.result)
+                job.done.set()
+
+    def perform(self, request):
+        command = request[0]
+        if command == "identify":
+            identity = self.meter.identify()
+            return {
+                    "model": identity.model,
+                    "firmware": identity.firmware,
+                    "date": identity.date.strftime("%Y-%m-%d"),
+                    "languages": identity.languages}
+        elif command == "datetime":
+            self.meter.set_datetime()
+            return {}
+        elif command == "screenshot":
+            return self.meter.screenshot()
+        elif command == "waveform":
+            data = self.meter.waveform(request[1])
+            data.channel = chr(ord('A')+int(request[1][0])-1)
+            return waveformJson(data)
+        elif command == "readings":
+            readings = []
+            for reading in self.meter.readings():
+                readings.append({
+                    "no": reading.no,
+                    "name": nos.get(reading.no),
+                    "source": sources.get(reading.source),
+                    "type": types[reading.thetype],
+                    "unit": units[reading.unit],
+                    "resolution": reading.resolution})
+            return readings
+        elif command == "reading":
+            return {"no": int(request[1]), "value": self.meter.reading(int(request[1]))}
+
+    def request(self, *request):
+        if not (request[0] in ["identify", "datetime", "screenshot", "readings"]
+                    and len(request) == 1
+                or request[0] in ["waveform", "reading"]
+                    and len(request) == 2
+                    and request[1].isdigit()):
+            raise KeyError(" ".join(request))
+
+        with self.lock:
+            if request in self.cache:
+                moment, result = self.cache[request]
+                if time.monotonic()-moment < self.ttl:
+                    return result
+                del self.cache[request]
+
+            # Identical requests that are already queued share one transaction
+            job = self.pending.get(request)
+            if job == None:
+                job = job_t()
+                job.done = threading.Event()
+                self.pending[request] = job
+                self.queue.put((request, job))
+
+        job.done.wait()
+        if job.error != None:
+            raise ScopeMeterError(job.error)
+        return job.result
+
+class HttpHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        request = tuple([part for part in self.path.split('/') if len(part)])
+        try:
+            result = self.server.acquisition.request(*request)
+        except (KeyError, IndexError):
+            self.send_error(404)
+            return
+        except ScopeMeterError as error:
+            self.send_error(502, str(error))
+            return
+
+        if request[0] == "screenshot":
+            kind = "image/png"
+            body = result
+        else:
+            kind = "application/json"
+            body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", kind)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One request per line ("waveform 10"), one JSON object per answer
+        for line in self.rfile:
+            try:
+                request = tuple(line.decode().split())
+            except UnicodeDecodeError:
+                self.wfile.write(json.dumps({"error": "request is not UTF-8"}).encode()+b"\n")
+                self.wfile.flush()
+                continue
+            if len(request) == 0:
+                continue
+            try:
+                result = self.server.acquisition.request(*request)
+                if request[0] == "screenshot":
+                    result = base64.b64encode(result).decode()
+                answer = {"result": result}
+            except (KeyError, IndexError):
+                answer = {"error": "unknown request"}
+            except ScopeMeterError as error:
+                answer = {"error": str(error)}
+            self.wfile.write(json.dumps(answer).encode()+b"\n")
+            self.wfile.flush()
+
+def daemon(meter, address, ttl=1.0):
+    if ':' in address and '/' not in address:
+        host, port = address.rsplit(':', 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), HttpHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socketserver.ThreadingUnixStreamServer(address, SocketHandler)
+    server.daemon_threads = True
+    server.acquisition = Acquisition(meter, ttl)
+
+    print("Serving ScopeMeter on {:s} (Ctrl-C to stop)".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("")
+    server.server_close()
+    if not (':' in address and '/' not in address):
+        os.remove(address)
+
+def export(directory, figs):
+    print("Exporting captures to {:s}...".format(directory), end="", flush=True)
+    count = 0
+    with phase("export"):
+        for fig in figs:
+            count += exportCaptures(directory, fig.waveforms)
+    print("done ({:d} captures)".format(count))
+
+def exportExtract(directory, outputName, since=None, until=None, channel=None):
+    if since != None:
+        since = datetime.datetime.strptime(catalogTime(since), "%Y-%m-%d %H:%M:%S")
+    if until != None:
+        until = datetime.datetime.strptime(catalogTime(until, True), "%Y-%m-%d %H:%M:%S")
+
+    print("Querying {:s}...".format(directory), end="", flush=True)
+    with phase("export query"):
+        columns = exportQuery(directory, since, until, channel)
+    names = list(columns)
+    rows = len(columns[names[0]]) if len(names) else 0
+    print("done ({:d} rows)".format(rows))
+
+    print("Writing "+outputName+"...", end="", flush=True)
+    with open(outputName, 'w') as outputFile:
+        outputFile.write(",".join(names)+"\n")
+        for row in zip(*[columns[name] for name in names]):
+            outputFile.write(",".join([str(value) for value in row])+"\n")
+    print("done")
+
+def execute(arguments):
+    # Returns how many figures failed to render
+    failed = 0
+    # Only runs that record or query captures create the catalog
+    catalog = None
+    if arguments.scan or arguments.query:
+        catalog = catalogOpen(arguments.catalog)
+
+    if arguments.scan:
+        print("Scanning {:s} for captures...".format(arguments.scan), end="", flush=True)
+        count = catalogScan(catalog, arguments.scan)
+        print("done ({:d} found)".format(count))
+
+    if arguments.query:
+        catalogPrint(catalogQuery(
+            catalog,
+            arguments.channel,
+            arguments.type,
+            arguments.unit,
+            arguments.since,
+            arguments.until))
+
+    if arguments.pyramid:
+        start = end = None
+        if arguments.span:
+            start, end = [float(value) for value in arguments.span.split(',')]
+        data = pyramidRead(arguments.pyramid, start, end, arguments.points)
+        filename = "{:s}_{:g}-{:g}{:s}.dat".format(
+                arguments.pyramid.rstrip('/').replace(".pyramid", ""),
+                data.x_zero,
+                data.x_zero+data.samples.shape[0]*data.delta_x,
+                data.x_unit)
+        print("Writing {:d} points {:g} {:s} apart to {:s}...".format(
+            data.samples.shape[0],
+            data.delta_x,
+            data.x_unit,
+            filename), end="", flush=True)
+        datFile = open(filename, 'w')
+        for j in range(data.samples.shape[0]):
+            datFile.write("{:.5e}".format(data.x_zero+j*data.delta_x))
+            for k in range(data.samples.shape[1]):
+                datFile.write(" {:.5e}".format(data.samples[j][k]))
+            datFile.write("\n")
+        datFile.close()
+        print("done")
+
+    if arguments.merge:
+        merge(arguments.merge, arguments.clocks, arguments.merge_step)
+
+    if arguments.discover:
+        print("Probing serial ports...", end="", flush=True)
+        ports = discoverPorts(arguments.discover_timeout)
+        print("done ({:d} found)".format(len(ports)))
+        portsWrite(arguments.port_cache, ports)
+        portsPrint(ports)
+
+    if arguments.batch:
+        batch(arguments.batch, arguments.batch_output, arguments.jobs)
+
+    if arguments.export_query:
+        exportExtract(
+                arguments.export_query,
+                arguments.export_output,
+                arguments.since,
+                arguments.until,
+                arguments.channel)
+
+    if arguments.from_captures:
+        os.chdir(arguments.from_captures)
+        print("Loading saved figures...", end="", flush=True)
+        figs = figuresRead(".")
+        print("done ({:d} found)".format(len(figs)))
+        if arguments.export:
+            export(arguments.export, figs)
+        if arguments.tex:
+            with phase("tex generation"):
+                tex(figs)
+            if arguments.render:
+                with phase("rendering"):
+                    failed += render("tex", figs, arguments.jobs)
+        if arguments.html:
+            with phase("html generation"):
+                html(figs, arguments.page_size, arguments.interactive)
+            if arguments.render:
+                with phase("rendering"):
+                    failed += render("html", figs, arguments.jobs)
+        return failed
+
+    if not (arguments.identify
+            or arguments.clock
+            or arguments.datetime
+            or arguments.screenshot
+            or arguments.tex
+            or arguments.html
+            or arguments.export
+            or arguments.daemon
+            or arguments.watch):
+        return failed
+
+    local = None
+    if arguments.measure:
+        local = []
+        for name in arguments.measure.lower().split(','):
+            name = name.strip()
+            if name == 'all':
+                local = None
+                break
+            if name not in [thetype.lower() for thetype in types if thetype]:
+                print("error: unknown measurement type “{:s}”".format(name))
+                exit(1)
+            local.append(name)
+        if local == None:
+            local = [thetype.lower() for thetype in types if thetype]
+
+    if arguments.meter:
+        arguments.port = findMeter(
+                arguments.meter,
+                arguments.port_cache,
+                arguments.discover_timeout)
+
+    filter = None
+    if arguments.filter:
+        filter = filterParse(arguments.filter)
+
+    meter = initializePort(arguments.port)
+    meter.filter = filter
+
     if arguments.identify:
-        identify(port)
+        identify(meter)
+
+    clockName = arguments.meter or arguments.port
+    if arguments.clock or arguments.datetime:
+        fit = clock(meter, arguments.clocks, clockName)
 
     if arguments.datetime:
-        dateTime(port)
+        if abs(clockAt(fit, time.time())) > arguments.resync:
+            dateTime(meter)
+            # The old measurements describe a clock that is no more
+            clocks = clocksRead(arguments.clocks)
+            del clocks[clockName]
+            clocksWrite(arguments.clocks, clocks)
+        else:
+            print("Clock within {:g} s, not setting it".format(arguments.resync))
 
     if arguments.screenshot:
-        screenshot(port)
-
-    if arguments.tex or arguments.html:
-        figs = figures(port)
+        screenshot(meter)
+
+    if arguments.tex or arguments.html or arguments.export:
+        trigger = None
+        if arguments.trigger:
+            trigger = triggerParse(arguments.trigger, arguments.trigger_context)
+        if catalog == None and not arguments.no_catalog:
+            catalog = catalogOpen(arguments.catalog)
+        figs = figures(
+                meter,
+                catalog,
+                arguments.raw,
+                local,
+                arguments.average,
+                trigger)
+        if arguments.export:
+            export(arguments.export, figs)
         if arguments.tex:
-            tex(figs)
+            with phase("tex generation"):
+                tex(figs)
+            if arguments.render:
+                with phase("rendering"):
+                    failed += render("tex", figs, arguments.jobs)
         if arguments.html:
-            html(figs)
-
-arguments = processArguments()
-port = initializePort(arguments.port)
-execute(arguments, port)
+            with phase("html generation"):
+                html(figs, arguments.page_size, arguments.interactive)
+            if arguments.render:
+                with phase("rendering"):
+                    failed += render("html", figs, arguments.jobs)
+
+    if arguments.daemon:
+        daemon(meter, arguments.daemon, arguments.cache_ttl)
+
+    if arguments.watch:
+        inputs = None
+        if arguments.watch_sources:
+            inputs = [source.strip() for source in arguments.watch_sources.split(',')]
+        watch(meter, arguments.watch, arguments.poll, inputs, arguments.watch_log)
+
+    meter.close()
+    return failed
+
+if __name__ == "__main__":
+    arguments = processArguments()
+    profiler = profileStart(arguments.profile, arguments.profile_dump)
+    writerStart(arguments.write_queue)
+    try:
+        failed = execute(arguments)
+    except ScopeMeterError as error:
+        print("error: "+str(error))
+        exit(1)
+    finally:
+        failures = writerStop()
+        profileStop(profiler, arguments.profile_dump)
+    if failures or failed:
+        exit(1)